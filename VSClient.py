@@ -1,172 +1,343 @@
-from flask import Flask, render_template_string, request, url_for
+from flask import Flask, render_template_string, request, url_for, jsonify, Response
 import socket
-import cv2
 import os
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
 import base64
-from PIL import Image
 import random
 import threading
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pkcs1_15
 from Crypto.Hash import SHA256
 import subprocess
+import hashlib
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from carrier_cache import hash_file
+from frame_index import index_path, load_frame_index
+from ingest import IngestFile
+from metrics import Metrics, Trace
+from profiling import SessionProfiler
+from payload import read_payload
+from preview import PreviewCache
+from protocol import (MSG_DH_PUBLIC, MSG_PUBLIC_KEY, MSG_VIDEO, MSG_FRAME_INDEX, CHUNK_SIZE, async_send_message,
+                      async_recv_message, async_recv_file)
+from sharding import is_shard, read_shard_header, shard_frames, gather_shards
+from video_io import av, count_frames, read_frames_at, probe_video, collect_frames
 
 app = Flask(__name__)
 public_key = None  # Global variable to store the public key
+receive_buffer = bytearray(CHUNK_SIZE)  # Reused across sessions for incoming video
+shard_pool = ProcessPoolExecutor()  # Parallel extraction of sharded messages
+received_video_path = 'static/videos/received_video.avi'
+received_digest = None  # SHA-256 of the video at received_video_path, computed while receiving
+
+# Tee the incoming video to disk, the preview transcoder and a decoder that
+# picks out the secret frames as their bytes arrive (needs PyAV)
+streamed_receive = True
+frame_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='frames')
+prefetched = None  # (secret1, secret2, Future of {frame_number: frame}) for the video at received_video_path
+metrics = Metrics('vsclient')  # Stage timings and counters for /metrics, receive/decrypt traces for /traces
+profiler = SessionProfiler.from_env()  # cProfile/tracemalloc dumps for a sampled fraction of operations (VS_PROFILE_*)
 
 # Ensure the static directory exists to store received video
 if not os.path.exists('static/videos'):
     os.makedirs('static/videos')
 
+# Codecs browsers play as-is; these are remuxed into MP4 instead of transcoded
+REMUX_CODECS = ('h264',)
+
 # Function to verify the RSA signature
 def verify_signature(signature, message, public_key):
     # Create a SHA-256 hash of the message
     hash_data = SHA256.new(message.encode())
 
-    # Decode the signature from base64
-    decoded_signature = base64.b64decode(signature)
-
     # Verify the signature
     try:
-        pkcs1_15.new(public_key).verify(hash_data, decoded_signature)
+        pkcs1_15.new(public_key).verify(hash_data, signature)
         print("Signature is valid.")
         return True
     except (ValueError, TypeError):
         print("Signature verification failed.")
         return False
 
-def extract_frame(video_path, frame_number):
-    output_image_path = f"frame_{frame_number}.png"
-    vidObj = cv2.VideoCapture(video_path)
-    total_frames = int(vidObj.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    if frame_number >= total_frames:
-        print(f"Frame number {frame_number} exceeds total frames ({total_frames})")
-        return False
-
-    vidObj.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    success, image = vidObj.read()
-    if success:
-        cv2.imwrite(output_image_path, image)
-        print(f"Frame {frame_number} saved as {output_image_path}")
-    vidObj.release()
-    return success, output_image_path
-
-def decode_image(image_path):
-    image = Image.open(image_path)
-    width, height = image.size
-
-    data_bits = ""
-    for x in range(width):
-        for y in range(height):
-            pixel = list(image.getpixel((x, y)))
-            for i in range(3):  # RGB
-                data_bits += str(pixel[i] & 1)
-
-    data_bytes = [data_bits[i:i + 8] for i in range(0, len(data_bits), 8)]
-    decoded_data = "".join([chr(int(byte, 2)) for byte in data_bytes])
-    delimiter_index = decoded_data.find("###")
-    return decoded_data[:delimiter_index] if delimiter_index != -1 else None
+# Returns the raw payload bytes, from either the binary container or legacy base64 text
+def decode_image(frame):
+    return read_payload(frame)
+
+# Frames straight from their packets when the server sent an index for the
+# video, otherwise by seeking through it
+def read_video_frames(video_path, frame_numbers):
+    frame_index = load_frame_index(video_path)
+    if frame_index is not None:
+        return frame_index.read_frames(video_path, frame_numbers)
+    return read_frames_at(video_path, frame_numbers)
+
+# Message was too large for one frame: collect the remaining shards and reassemble.
+# Shard frames already in `decoded` are not read again.
+def gather_message_shards(video_path, first_frame, message_frame_number, key_frame_number, decoded=None):
+    decoded = decoded or {}
+    _, count, _, _, _ = read_shard_header(first_frame)
+    frame_index = load_frame_index(video_path)
+    frame_count = frame_index.frame_count if frame_index is not None else count_frames(video_path)
+    frame_numbers = shard_frames(message_frame_number, count, frame_count, reserved={0, key_frame_number})
+    frames = {frame_number: decoded[frame_number] for frame_number in frame_numbers if frame_number in decoded}
+    missing = [frame_number for frame_number in frame_numbers[1:] if frame_number not in frames]
+    if missing:
+        frames.update(read_video_frames(video_path, missing))
+    frames[message_frame_number] = first_frame
+    if len(frames) != count:
+        raise Exception(f"Failed to extract message shard frames {sorted(set(frame_numbers) - set(frames))}")
+    return gather_shards([frames[frame_number] for frame_number in frame_numbers], shard_pool)
 
 def decrypt_message(encrypted_message, key):
-    encrypted_message = base64.b64decode(encrypted_message)
     iv = encrypted_message[:AES.block_size]
     cipher = AES.new(key, AES.MODE_CBC, iv)
     decrypted_message = unpad(cipher.decrypt(encrypted_message[AES.block_size:]), AES.block_size)
     return decrypted_message.decode('utf-8')
 
 def start_client():
-    global public_key
+    trace = metrics.trace(kind='receive')
+    sampled = profiler.sample()
+    if sampled:
+        trace.attributes['profiled'] = True
+    try:
+        with profiler.section(trace.id, 'receive', sampled):
+            result = asyncio.run(start_client_async(trace))
+    except Exception as e:
+        trace.finish('failed', str(e))
+        raise
+    trace.finish('complete')
+    return result
+
+async def start_client_async(trace=None):
+    global public_key, received_digest, prefetched
+    trace = trace if trace is not None else Trace()
+    loop = asyncio.get_running_loop()
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(('localhost', 12345))
-
-    # First Diffie-Hellman for Key Frame
-    alice_public1 = int(client_socket.recv(1024).decode())
-    bob_private1 = random.randint(1, 23 - 1)
-    bob_public1 = pow(5, bob_private1, 23)
-    client_socket.sendall(f"{bob_public1}".encode())
-    shared_secret1 = pow(alice_public1, bob_private1, 23)
-    print(f"Shared Secret for Key Frame: {shared_secret1}")
-
-    # Second Diffie-Hellman for Message Frame
-    alice_public2 = int(client_socket.recv(1024).decode())
-    bob_private2 = random.randint(1, 23 - 1)
-    bob_public2 = pow(5, bob_private2, 23)
-    client_socket.sendall(f"{bob_public2}".encode())
-    shared_secret2 = pow(alice_public2, bob_private2, 23)
-    print(f"Shared Secret for Message Frame: {shared_secret2}")
-
-    # Receive Public Key
-    public_key_data = client_socket.recv(4096).decode()
-    if public_key_data.startswith("PUBLIC_KEY:"):
-        encoded_public_key = public_key_data.split("PUBLIC_KEY:")[1]
+    client_socket.setblocking(False)
+    try:
+        with trace.stage('connect'):
+            await loop.sock_connect(client_socket, ('localhost', 12345))
+
+        with trace.stage('handshake'):
+            # First Diffie-Hellman for Key Frame
+            alice_public1 = int((await async_recv_message(client_socket, MSG_DH_PUBLIC))[1].decode())
+            bob_private1 = random.randint(1, 23 - 1)
+            bob_public1 = pow(5, bob_private1, 23)
+            await async_send_message(client_socket, MSG_DH_PUBLIC, f"{bob_public1}".encode())
+            shared_secret1 = pow(alice_public1, bob_private1, 23)
+            print(f"Shared Secret for Key Frame: {shared_secret1}")
+
+            # Second Diffie-Hellman for Message Frame
+            alice_public2 = int((await async_recv_message(client_socket, MSG_DH_PUBLIC))[1].decode())
+            bob_private2 = random.randint(1, 23 - 1)
+            bob_public2 = pow(5, bob_private2, 23)
+            await async_send_message(client_socket, MSG_DH_PUBLIC, f"{bob_public2}".encode())
+            shared_secret2 = pow(alice_public2, bob_private2, 23)
+            print(f"Shared Secret for Message Frame: {shared_secret2}")
+
+        # Receive Public Key. Its arrival also marks the server's embed time.
+        with trace.stage('wait_server'):
+            _, encoded_public_key = await async_recv_message(client_socket, MSG_PUBLIC_KEY)
         public_key = RSA.import_key(base64.b64decode(encoded_public_key))
         print("Public key received and imported.")
-
-    # Receive Video File
-    output_video_path = 'static/videos/received_video.avi'
-    with open(output_video_path, 'wb') as f:
-        while True:
-            video_data = client_socket.recv(4096)
-            if not video_data:
-                break
-            f.write(video_data)
-    client_socket.close()
+        _, frame_index = await async_recv_message(client_socket, MSG_FRAME_INDEX)
+
+        # Receive Video File. The previous video is replaced only once the new
+        # one is complete, so a preview still being built from it is unaffected.
+        output_video_path = received_video_path
+        partial_path = output_video_path + '.part'
+        prefetched = None
+        with trace.stage('receive'):
+            if streamed_receive and av is not None:
+                received_digest, frames = await receive_video_streaming(client_socket, partial_path,
+                                                                        shared_secret1, shared_secret2)
+                prefetched = (shared_secret1, shared_secret2, frames)
+            else:
+                digest = hashlib.sha256()
+                await async_recv_file(client_socket, partial_path, MSG_VIDEO, receive_buffer, digest)
+                received_digest = digest.hexdigest()
+        # The old index goes before the video is replaced and the new one is
+        # written after it, so an index never sits next to a different video
+        if os.path.exists(index_path(output_video_path)):
+            os.remove(index_path(output_video_path))
+        os.replace(partial_path, output_video_path)
+        if frame_index:
+            with open(index_path(output_video_path), 'wb') as f:
+                f.write(frame_index)
+        metrics.count('video_bytes_received_total', "Video bytes received from the server",
+                      os.path.getsize(output_video_path))
+        trace.attributes['digest'] = received_digest
+    finally:
+        client_socket.close()
     print("Video and public key received successfully.")
 
     return shared_secret1, shared_secret2, output_video_path
 
+# Receive the video to disk while feeding the preview transcoder and decoding
+# the key, message and signature frames as soon as their bytes arrive.
+# Returns (digest, Future of the decoded frames).
+async def receive_video_streaming(client_socket, path, shared_secret1, shared_secret2):
+    ingest = IngestFile(path)
+    frames = frame_pool.submit(collect_secret_frames, ingest.open_reader(), shared_secret1, shared_secret2)
+    preview_stream = preview_cache.open_stream()
+    tee = [preview_stream] if preview_stream is not None else []
+    try:
+        await async_recv_file(client_socket, ingest, MSG_VIDEO, receive_buffer, tee=tee)
+    except BaseException:
+        ingest.close()
+        if preview_stream is not None:
+            preview_stream.discard()
+        raise
+    ingest.finish()
+    if preview_stream is not None:
+        preview_cache.finish_stream(preview_stream, ingest.digest)
+    return ingest.digest, frames
+
+# Runs on frame_pool alongside the receive. Follows the message frame into
+# the rest of its shards when it turns out to be sharded.
+def collect_secret_frames(reader, key_frame_number, message_frame_number):
+    def more_shards(frame_number, frame, frame_count):
+        if frame_number == message_frame_number and frame_count and is_shard(frame):
+            _, count, _, _, _ = read_shard_header(frame)
+            return shard_frames(message_frame_number, count, frame_count, reserved={0, key_frame_number})
+        return ()
+
+    with reader:
+        return collect_frames(reader, {0, key_frame_number, message_frame_number}, more_shards)
+
+def preview_command(input_path, output_path, remux=False):
+    if remux:
+        codec_args = ['-c', 'copy']
+    else:
+        codec_args = ['-vcodec', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-acodec', 'aac']
+    return ['ffmpeg', '-y', '-i', input_path, *codec_args, '-movflags', '+faststart', '-f', 'mp4', output_path]
+
+# Remux when the video is already browser-playable, otherwise transcode with a fast preset
 def convert_avi_to_mp4(input_path, output_path):
-    command = [
-        'ffmpeg', '-i', input_path, '-vcodec', 'libx264', '-acodec', 'aac', output_path
-    ]
-    subprocess.run(command, check=True)
+    remux = probe_video(input_path)['codec'] in REMUX_CODECS
+    subprocess.run(preview_command(input_path, output_path, remux), check=True)
+
+# The streamed preview reads the video from stdin
+preview_cache = PreviewCache('static/videos/previews', convert=metrics.timed('preview', convert_avi_to_mp4),
+                             stream_command=partial(preview_command, 'pipe:0'), max_bytes=1024 ** 3)
+metrics.gauge('preview_cache_bytes', "Bytes held by the preview cache", lambda: preview_cache.stats()['bytes'])
 
+# Decrypts right away; the MP4 preview is built in the background (or found
+# in the cache) and appears at the returned path once ready
 def decrypt_video(shared_secret1, shared_secret2, video_path):
-    global public_key
-    # Decode AES Key from Key Frame
+    trace = metrics.trace(kind='decrypt')
+    sampled = profiler.sample()
+    if sampled:
+        trace.attributes['profiled'] = True
+    try:
+        with profiler.section(trace.id, 'decrypt', sampled):
+            result = decrypt_traced(shared_secret1, shared_secret2, video_path, trace)
+    except Exception as e:
+        trace.finish('failed', str(e))
+        raise
+    trace.finish('complete')
+    return result
+
+def decrypt_traced(shared_secret1, shared_secret2, video_path, trace):
+    # Use the frames decoded while the video was arriving, if they are for these secrets
+    frames = None
+    if video_path == received_video_path and prefetched is not None and prefetched[:2] == (shared_secret1, shared_secret2):
+        try:
+            with trace.stage('wait_frames'):
+                frames = prefetched[2].result()
+        except Exception as e:
+            print(f"Frames decoded during receive are unavailable ({e}), reading them from the video")
+
+    decrypted_message, is_valid_signature = extract_message(video_path, shared_secret1, shared_secret2, public_key,
+                                                            frames, trace)
+
+    with trace.stage('preview_request'):
+        if video_path == received_video_path and received_digest is not None:
+            digest = received_digest
+        else:
+            digest = hash_file(video_path)
+        preview_cache.request(digest, video_path)
+    trace.attributes['digest'] = digest
+
+    return decrypted_message, is_valid_signature, preview_cache.path(digest)
+
+# Recover, decrypt and verify the message hidden in a received video.
+# `decoded` may hold frames that were already decoded, by frame number.
+def extract_message(video_path, shared_secret1, shared_secret2, public_key, decoded=None, trace=None):
+    trace = trace if trace is not None else Trace()
+    with trace.stage('extract'):
+        aes_key, encrypted_message, signature = extract_payloads(video_path, shared_secret1, shared_secret2, decoded)
+
+    # Decrypt the message using the decoded AES key
+    with trace.stage('decrypt'):
+        decrypted_message = decrypt_message(encrypted_message, aes_key)
+    print(f"Decrypted message: {decrypted_message}")
+
+    # Verify the signature
+    with trace.stage('verify'):
+        is_valid_signature = verify_signature(signature, decrypted_message, public_key)
+    print("Signature valid:", is_valid_signature)
+
+    return decrypted_message, is_valid_signature
+
+# Returns the raw (aes_key, encrypted_message, signature) hidden in a video
+def extract_payloads(video_path, shared_secret1, shared_secret2, decoded=None):
+    # Pull the Key, Message and Signature Frames in a single pass over the video
     key_frame_number = shared_secret1
-    success, key_frame_image_path = extract_frame(video_path, key_frame_number)
-    if not success:
+    message_frame_number = shared_secret2
+    signature_frame_number = 0
+    decoded = decoded or {}
+    wanted = [key_frame_number, message_frame_number, signature_frame_number]
+    frames = {frame_number: decoded[frame_number] for frame_number in wanted if frame_number in decoded}
+    if len(frames) < len(set(wanted)):
+        frames.update(read_video_frames(video_path, [frame_number for frame_number in wanted
+                                                     if frame_number not in frames]))
+
+    # Decode AES Key from Key Frame
+    if key_frame_number not in frames:
         raise Exception(f"Failed to extract key frame {key_frame_number}")
-    encoded_key = decode_image(key_frame_image_path)
-    aes_key = base64.b64decode(encoded_key.encode('utf-8'))
+    aes_key = decode_image(frames[key_frame_number])
 
     # Decode Encrypted Message from Message Frame
-    message_frame_number = shared_secret2
-    success, message_frame_image_path = extract_frame(video_path, message_frame_number)
-    if not success:
+    if message_frame_number not in frames:
         raise Exception(f"Failed to extract message frame {message_frame_number}")
-    encoded_message = decode_image(message_frame_image_path)
+    if is_shard(frames[message_frame_number]):
+        encrypted_message = gather_message_shards(video_path, frames[message_frame_number],
+                                                  message_frame_number, key_frame_number, decoded)
+    else:
+        encrypted_message = decode_image(frames[message_frame_number])
 
     # Decode Signature from Signature Frame
-    signature_frame_number = 0
-    success, signature_frame_path = extract_frame(video_path, signature_frame_number)
-    if not success:
+    if signature_frame_number not in frames:
         raise Exception(f"Failed to extract signature frame {signature_frame_number}")
-    signature = decode_image(signature_frame_path)
+    signature = decode_image(frames[signature_frame_number])
 
-    # Decrypt the message using the decoded AES key
-    decrypted_message = decrypt_message(encoded_message, aes_key)
-    print(f"Decrypted message: {decrypted_message}")
+    return aes_key, encrypted_message, signature
 
-    # Verify the signature
-    is_valid_signature = verify_signature(signature, decrypted_message, public_key)
-    print("Signature valid:", is_valid_signature)
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-    # Convert AVI to MP4
-    mp4_video_path = 'static/videos/received_video.mp4'
-    convert_avi_to_mp4(video_path, mp4_video_path)
+@app.route('/traces')
+def list_traces():
+    return jsonify(metrics.traces())
 
-    return decrypted_message, is_valid_signature, mp4_video_path
+@app.route('/preview/<digest>')
+def preview_status(digest):
+    state, error = preview_cache.status(digest)
+    return jsonify({'state': state, 'error': error,
+                    'url': url_for('static', filename=f'videos/previews/{digest}.mp4')})
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     global public_key
     message = ""
     video_url = None
+    preview_status_url = None
     if request.method == 'POST':
         action = request.form['action']
         if action == 'connect':
@@ -180,10 +351,13 @@ def index():
             try:
                 shared_secret1 = int(request.form['shared_secret1'])
                 shared_secret2 = int(request.form['shared_secret2'])
-                video_path = 'static/videos/received_video.avi'
+                video_path = received_video_path
                 decrypted_message, is_valid_signature, mp4_video_path = decrypt_video(shared_secret1, shared_secret2, video_path)
                 message = f"Decrypted message: {decrypted_message} \n Signature valid: {is_valid_signature}"
-                video_url = url_for('static', filename='videos/received_video.mp4') if is_valid_signature else None
+                if is_valid_signature:
+                    digest = os.path.splitext(os.path.basename(mp4_video_path))[0]
+                    video_url = url_for('static', filename=f'videos/previews/{digest}.mp4')
+                    preview_status_url = url_for('preview_status', digest=digest)
             except Exception as e:
                 message = f"Error decrypting video: {str(e)}"
 
@@ -339,14 +513,35 @@ def index():
             </div>
             {% endif %}
             {% if video_url %}
+            <div class="message" id="previewStatus">Preparing video preview...</div>
             <video controls>
-                <source src="{{ video_url }}" type="video/mp4">
+                <source type="video/mp4">
                 Your browser does not support the video tag.
             </video>
             <script>
-                document.addEventListener('DOMContentLoaded', function() {
-                    document.querySelector('video').style.display = 'block';
-                });
+                // The preview is built in the background; poll until it is ready
+                function checkPreview() {
+                    fetch('{{ preview_status_url }}')
+                        .then(response => response.json())
+                        .then(status => {
+                            const note = document.getElementById('previewStatus');
+                            if (status.state === 'ready') {
+                                const video = document.querySelector('video');
+                                video.querySelector('source').src = '{{ video_url }}';
+                                video.load();
+                                video.style.display = 'block';
+                                note.style.display = 'none';
+                            } else if (status.state === 'failed') {
+                                note.textContent = 'Preview failed: ' + status.error;
+                            } else if (status.state === 'missing') {
+                                // Evicted, or requested before the client restarted
+                                note.textContent = 'Preview is no longer available; decrypt again to rebuild it';
+                            } else {
+                                setTimeout(checkPreview, 1000);
+                            }
+                        });
+                }
+                document.addEventListener('DOMContentLoaded', checkPreview);
             </script>
             {% endif %}
         </div>
@@ -406,7 +601,7 @@ def index():
         </script>
     </body>
     </html>
-    ''', message=message, video_url=video_url)
+    ''', message=message, video_url=video_url, preview_status_url=preview_status_url)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
@@ -1,4 +1,5 @@
-from flask import Flask, request, render_template_string
+from flask import Flask, Request, request, render_template_string, jsonify, Response
+from werkzeug.formparser import FormDataParser, MultiPartParser, default_stream_factory
 import socket
 import cv2
 import os
@@ -7,20 +8,183 @@ from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad
 from Crypto.Random import get_random_bytes
 import base64
+import json
 import random
 import threading
+import queue
+import asyncio
+import uuid
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+
+from capacity import check_message_fits
+from carrier_cache import CarrierCache, hash_file
+from frame_index import build_frame_index
+from frame_store import FrameStore, index_path, remove_store
+from ingest import IngestFile
+from jobs import JobProgress
+from metrics import Metrics, Trace
+from profiling import SessionProfiler
+from keypool import KeyPool
+from lsb import embed_data
+from payload import embed_payload, payload_capacity
+from protocol import (MSG_DH_PUBLIC, MSG_PUBLIC_KEY, MSG_VIDEO, MSG_FRAME_INDEX, async_send_message, async_recv_message,
+                      async_send_file)
+from sharding import shard_capacity, split_payload, shard_frames, embed_shards, embed_store_shards
+from video_io import (av, get_video_properties, count_frames, read_frames_at, write_video, embed_video, prepare_carrier,
+                      decode_to_carrier, read_frames)
 
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pkcs1_15
 from Crypto.Hash import SHA256
 
 
+
+# Only the form's video field is streamed to disk; other file parts are
+# spooled by werkzeug as usual
+class IngestMultiPartParser(MultiPartParser):
+    def start_file_streaming(self, event, total_content_length):
+        if event.name == 'file':
+            return super().start_file_streaming(event, total_content_length)
+        return default_stream_factory(total_content_length=total_content_length, filename=event.filename,
+                                      content_type=event.headers.get('content-type'))
+
+
+class IngestFormDataParser(FormDataParser):
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = IngestMultiPartParser(stream_factory=self.stream_factory, max_form_memory_size=self.max_form_memory_size,
+                                       max_form_parts=self.max_form_parts, cls=self.cls)
+        boundary = options.get('boundary', '').encode('ascii')
+        if not boundary:
+            raise ValueError("Missing boundary")
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+
+# Uploads are written straight to uploads/ and, when streamed_ingest is on,
+# decoded into a carrier while the request body is still arriving. Streamed
+# uploads that no session took over (a second file part, a truncated body,
+# a rejected form) are cancelled and deleted when the request closes.
+class IngestRequest(Request):
+    form_data_parser_class = IngestFormDataParser
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ingests = []  # IngestFiles streamed for this request and not yet claimed
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not (streamed_ingest and splice_mode and av is not None and filename):
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        ingest = IngestFile(os.path.join('uploads', f"{uuid.uuid4().hex[:12]}_{filename}"))
+        ingest.decoding = ingest_pool.submit(decode_upload, ingest)
+        self.ingests.append(ingest)
+        return ingest
+
+    # The upload route takes over the ingest it turns into a session or discards
+    def claim_ingest(self, ingest):
+        self.ingests.remove(ingest)
+        return ingest
+
+    def close(self):
+        super().close()
+        for ingest in self.ingests:
+            ingest.close()
+            discard_upload(ingest.path, ingest)
+        self.ingests = []
+
+
 app = Flask(__name__)
+app.request_class = IngestRequest
 
-shared_secrets = {'secret1': None, 'secret2': None}
-processing_complete = False
 server_socket = None
 
+# Copy untouched frames at the packet level when the upload is intra-only FFV1
+splice_mode = True
+
+# Decode uploads as they stream in rather than after they are saved (needs
+# PyAV and splice mode). Containers that cannot be read front to back, like
+# MP4 with its index at the end, are decoded after the upload as before.
+streamed_ingest = True
+
+# Prepared carriers keyed by upload content, so a repeat carrier skips decoding
+carrier_cache = CarrierCache('carrier_cache', max_bytes=5 * 1024 ** 3)
+
+# Also keep each carrier's frames decoded in a memory-mapped frame store
+# (beside the cached carrier, or per session without splice mode). Shard
+# workers read their frames from it directly, and a full re-encode reads it
+# instead of decoding, so without splicing the decode happens before the
+# handshake. Costs width * height * 3 bytes of disk per frame.
+frame_store_mode = False
+
+# Send a frame -> packet index of the output video ahead of it, so the client
+# decodes the frames it needs straight from their packets
+send_frame_index = True
+
+# Low bits used per colour channel (1-4); more bits means fewer frames per
+# message at the cost of visibility. Recorded in every payload header.
+embed_depth = 1
+
+# Most frames a single message may be spread over (None: as many as the video has)
+max_message_frames = None
+
+# Concurrency limits: connections handled at once, embed workers, and how
+# many sessions may wait for a worker before new connections stop being
+# accepted. Idle connections only cost a coroutine, so max_sessions can be high.
+max_sessions = 4096
+embed_workers = os.cpu_count() or 4
+embed_queue_limit = 16
+
+# Seconds the listener waits after a failed accept (e.g. out of file descriptors)
+accept_retry_delay = 0.5
+
+# Uploads accepted but not yet finished; further uploads get a 503 instead
+# of queueing work without bound
+max_pending_sessions = 64
+
+# Finished sessions kept for the status page and /jobs; older ones are forgotten
+keep_finished_sessions = 256
+
+# Seconds a client has to complete the key exchange once connected, and
+# seconds an upload waits for a client before its session expires
+handshake_timeout = 30
+pending_session_ttl = 3600
+
+sessions = {}  # Session id -> Session, for the status page
+sessions_lock = threading.Lock()
+pending_sessions = queue.Queue()  # Uploaded sessions waiting for a client to connect
+embed_pool = ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix='embed')
+ingest_pool = ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix='ingest')  # Decodes of arriving uploads
+shard_pool = ProcessPoolExecutor(max_workers=embed_workers)  # Parallel per-frame shard embedding
+listener_lock = threading.Lock()
+upload_slots = threading.BoundedSemaphore(max_pending_sessions)
+metrics = Metrics('vsserver')  # Stage timings and counters for /metrics, session traces for /traces
+profiler = SessionProfiler.from_env()  # cProfile/tracemalloc dumps for a sampled fraction of sessions (VS_PROFILE_*)
+
+
+class ServerBusy(Exception):
+    pass
+
+
+# State for one upload, from the file landing until the video is sent
+class Session:
+    def __init__(self, video_path, message, ingest=None, remove_upload=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.video_path = video_path
+        self.remove_upload = remove_upload  # Delete video_path when the session ends
+        self.message = message
+        self.ingest = ingest  # IngestFile when the upload was decoded while streaming in
+        self.shared_secrets = {'secret1': None, 'secret2': None}
+        self.processing_complete = False
+        self.error = None
+        self.preparation = None  # Future for prepare_session, started on upload
+        self.progress = JobProgress()  # State and per-stage progress for /jobs
+        self.trace = metrics.trace(self.id)  # Stage timings for /traces and /metrics
+        self.profiled = profiler.sample()  # Prepare and embed are profiled into profiler.directory
+        if self.profiled:
+            self.trace.attributes['profiled'] = True
+        self.done = threading.Event()
+
 # Step 1: Generate RSA keys
 def generate_rsa_keys():
     key = RSA.generate(2048)
@@ -28,22 +192,14 @@ def generate_rsa_keys():
     public_key = key.publickey().export_key()
     return private_key, public_key
 
+# Pre-generated keypairs, refilled in the background and rotated after key_lifetime seconds
+key_pool = KeyPool(generate_rsa_keys, size=8, key_lifetime=3600)
+
 # Step 2: Sign a custom message
 def create_signature(message, private_key):
     hash_data = SHA256.new(message.encode())
     rsa_key = RSA.import_key(private_key)
-    signature = pkcs1_15.new(rsa_key).sign(hash_data)
-    return base64.b64encode(signature).decode('utf-8')
-
-
-def get_video_properties(video_path):
-    vidObj = cv2.VideoCapture(video_path)
-    fps = vidObj.get(cv2.CAP_PROP_FPS)
-    frame_count = int(vidObj.get(cv2.CAP_PROP_FRAME_COUNT))
-    width = int(vidObj.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(vidObj.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    vidObj.release()
-    return fps, frame_count, (width, height)
+    return pkcs1_15.new(rsa_key).sign(hash_data)
 
 
 def extract_frames(video_path, output_folder):
@@ -66,51 +222,25 @@ def extract_frames(video_path, output_folder):
 
 
 def frames_to_video(frame_folder, output_video_path, fps, frame_count, resolution):
-    img_array = []
-    for count in range(frame_count):
-        frame_path = os.path.join(frame_folder, f"frame{count}.png")
-        img = cv2.imread(frame_path)
-        img_array.append(img)
-
-    out = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'FFV1'), fps, resolution)
-
-    for img in img_array:
-        out.write(img)
-
-    out.release()
-    print(f"Video saved as {output_video_path}")
+    frame_paths = (os.path.join(frame_folder, f"frame{count}.png") for count in range(frame_count))
+    write_video((cv2.imread(frame_path) for frame_path in frame_paths), output_video_path, fps, resolution)
 
 
 def encrypt_message(message, key):
     cipher = AES.new(key, AES.MODE_CBC)
     iv = cipher.iv
     encrypted_message = cipher.encrypt(pad(message.encode(), AES.block_size))
-    return base64.b64encode(iv + encrypted_message).decode('utf-8')
+    return iv + encrypted_message
 
 
 def encode_image(image_path, data, output_path):
     image = Image.open(image_path)
-    encoded_image = image.copy()
+    frame = np.array(image)
 
-    width, height = image.size
     data += "###"  # Delimiter to indicate the end
-    data_bits = "".join([format(ord(char), '08b') for char in data])
-
-    bit_index = 0
-    for x in range(width):
-        for y in range(height):
-            pixel = list(encoded_image.getpixel((x, y)))
-            for i in range(3):  # RGB
-                if bit_index < len(data_bits):
-                    pixel[i] = pixel[i] & ~1 | int(data_bits[bit_index])
-                    bit_index += 1
-            encoded_image.putpixel((x, y), tuple(pixel))
-            if bit_index >= len(data_bits):
-                break
-        if bit_index >= len(data_bits):
-            break
-
-    encoded_image.save(output_path)
+    encoded_frame = embed_data(frame, data, channel_order='rgb', in_place=True)
+
+    Image.fromarray(encoded_frame).save(output_path)
     print(f"Data encoded and saved in {output_path}")
 
 
@@ -122,96 +252,521 @@ def diffie_hellman_exchange():
     return private_key, public_key, prime, base
 
 
-def start_server(video_path, message):
-    global shared_secrets, processing_complete, server_socket
-
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('localhost', 12345))
-    server_socket.listen(1)
-    print("Server waiting for connection...")
-
-    conn, addr = server_socket.accept()
-    print(f"Connected by {addr}")
-
+# Queue an upload for the next client that connects, starting the listener if needed
+# Raises ServerBusy when max_pending_sessions uploads are already in flight.
+# With remove_upload the video is deleted once the session is over.
+def start_server(video_path, message, ingest=None, remove_upload=False):
+    if not upload_slots.acquire(blocking=False):
+        raise ServerBusy(f"{max_pending_sessions} uploads are already waiting, try again later")
+    session = Session(video_path, message, ingest, remove_upload)
+    with sessions_lock:
+        sessions[session.id] = session
+    key_pool.start()
+    session.preparation = embed_pool.submit(profiler.wrap(session.id, 'prepare', session.profiled, prepare_session),
+                                            session)
+    pending_sessions.put(session)
+    session.preparation.add_done_callback(partial(fail_unclaimed, session))
+    expiry = threading.Timer(pending_session_ttl, expire_unclaimed, args=(session,))
+    expiry.daemon = True
+    expiry.start()
+    ensure_listener()
+    return session
+
+
+# Take a session off the queue before a client does. False if a client
+# (or an earlier failure) already took it.
+def take_pending(session):
+    with pending_sessions.mutex:
+        try:
+            pending_sessions.queue.remove(session)
+        except ValueError:
+            return False
+    return True
+
+
+# A session whose preparation failed before a client took it fails at once,
+# leaving the queue and giving back its upload slot. Once a client has it,
+# run_session reports the failure instead.
+def fail_unclaimed(session, preparation):
+    if preparation.cancelled() or preparation.exception() is None:
+        return
+    if not take_pending(session):
+        return
+    fail_session(session, str(preparation.exception()))
+    end_session(session)
+    upload_slots.release()
+
+
+# No client came for the session within pending_session_ttl: release what
+# its preparation holds and give back its upload slot
+def expire_unclaimed(session):
+    if not take_pending(session):
+        return
+    session.preparation.add_done_callback(release_preparation)
+    fail_session(session, f"No client connected within {pending_session_ttl} seconds")
+    end_session(session)
+    upload_slots.release()
+
+
+def fail_session(session, error):
+    session.error = error
+    session.progress.fail_running()
+    session.progress.set_state('failed', error)
+    session.trace.finish('failed', error)
+    print(f"Session {session.id} failed: {error}")
+
+
+# Speculative work done as soon as the upload lands, while we wait for the
+# client: probe and decode the video into a spliceable carrier, encrypt,
+# take an RSA key and sign. Only the targeted-frame embed and the final
+# write are left for after the handshake.
+def prepare_session(session):
+    message = session.message
+
+    session.progress.begin('decode')
+    with session.trace.stage('decode'):
+        digest, carrier_path, frame_count, resolution = load_carrier(session)
+    session.progress.finish('decode')
+
+    prepared = {
+        'digest': digest,
+        'carrier_path': carrier_path,
+        'frame_store': None,
+        'frame_count': frame_count,
+        'resolution': resolution,
+    }
+    try:
+        if frame_store_mode:
+            with session.trace.stage('frame_store'):
+                prepared['frame_store'] = load_frame_store(session, digest, carrier_path)
+
+        # Generate AES Key and Encrypt Message
+        with session.trace.stage('encrypt'):
+            aes_key = get_random_bytes(16)
+            encrypted_message = encrypt_message(message, aes_key)
+        print(f"Encrypted message: {base64.b64encode(encrypted_message).decode('utf-8')}")
+
+        with session.trace.stage('keygen'):
+            private_key, public_key = key_pool.get()
+        with session.trace.stage('sign'):
+            signature = create_signature(message, private_key)
+    except BaseException:
+        release_prepared(prepared)
+        raise
+
+    prepared.update(aes_key=aes_key, encrypted_message=encrypted_message, signature=signature, public_key=public_key)
+    return prepared
+
+
+# Give back what prepare_session took: the carrier cache pin, or the
+# session's own frame store when the carrier is not cached
+def release_prepared(prepared):
+    if prepared['digest'] is not None:
+        carrier_cache.release(prepared['digest'])
+    elif prepared['frame_store'] is not None:
+        remove_store(prepared['frame_store'])
+
+
+# For a session that ends before it took over its preparation
+def release_preparation(preparation):
+    if not preparation.cancelled() and preparation.exception() is None:
+        release_prepared(preparation.result())
+
+
+# The spliceable carrier for a session's upload, from the carrier cache, the
+# decode done while it streamed in, or a fresh decode.
+# Returns (digest, carrier_path, frame_count, resolution).
+def load_carrier(session):
+    video_path = session.video_path
+    ingest = session.ingest
+    if splice_mode:
+        # A streamed upload was hashed as it arrived
+        digest = ingest.digest if ingest is not None else hash_file(video_path)
+        cached = carrier_cache.acquire(digest)
+        decoded = None
+        if cached is not None:
+            carrier_path, metadata = cached
+            frame_count, resolution = metadata['frame_count'], tuple(metadata['resolution'])
+            print(f"Carrier cache hit for {video_path}")
+            if ingest is not None:
+                ingest.cancel()
+                ingest.decoding.add_done_callback(remove_decoded_carrier)
+        elif ingest is not None:
+            # Follow the decode started while the upload arrived, from where it is now
+            report = session.progress.reporter('decode')
+            ingest.on_decoded = report
+            report(ingest.decoded)
+            decoded = ingest.decoding.result()
+        if cached is None and decoded is not None:
+            carrier_path, metadata = decoded
+            frame_count, resolution = metadata['frame_count'], metadata['resolution']
+            carrier_path = carrier_cache.put(digest, carrier_path, metadata, move=True)
+        elif cached is None:
+            carrier_path, frame_count = prepare_carrier(video_path, os.path.join('uploads', f"{session.id}_carrier.avi"),
+                                                        progress=session.progress.reporter('decode'))
+            fps, _, resolution = get_video_properties(carrier_path)
+            metadata = {'frame_count': frame_count, 'fps': fps, 'resolution': resolution}
+            carrier_path = carrier_cache.put(digest, carrier_path, metadata, move=carrier_path != video_path)
+    else:
+        digest = None
+        carrier_path, frame_count = video_path, count_frames(video_path)
+        _, _, resolution = get_video_properties(video_path)
+    return digest, carrier_path, frame_count, resolution
+
+
+# A frame store of the carrier, kept in the carrier cache next to it or, with
+# no cache entry, under uploads/ for this session only. Returns its path.
+def load_frame_store(session, digest, carrier_path):
+    if digest is not None:
+        store_path = carrier_cache.sidecar_path(digest, '.frames')
+    else:
+        store_path = os.path.join('uploads', f"{session.id}.frames")
+    if not os.path.exists(index_path(store_path)):
+        fps, _, resolution = get_video_properties(carrier_path)
+        FrameStore.create(store_path, read_frames(carrier_path), fps, resolution)
+        if digest is not None:
+            carrier_cache.refresh(digest)
+    return store_path
+
+
+# Runs on ingest_pool for the length of an upload, decoding frames as they
+# arrive. Returns (carrier_path, metadata), or None if the container cannot
+# be decoded front to back and has to be decoded from the finished file.
+def decode_upload(ingest):
+    carrier_path = os.path.splitext(ingest.path)[0] + '_carrier.avi'
+    try:
+        with ingest.open_reader() as reader:
+            frame_count, fps, resolution = decode_to_carrier(reader, carrier_path, progress=ingest.report_decoded)
+    except Exception as e:
+        if not ingest.cancelled:
+            print(f"Could not decode {ingest.path} while it was uploading ({e}), decoding after upload instead")
+        if os.path.exists(carrier_path):
+            os.remove(carrier_path)
+        return None
+    if ingest.failed or ingest.cancelled:
+        os.remove(carrier_path)
+        return None
+    return carrier_path, {'frame_count': frame_count, 'fps': fps, 'resolution': resolution}
+
+
+def remove_decoded_carrier(decoding):
+    decoded = decoding.result()
+    if decoded is not None and os.path.exists(decoded[0]):
+        os.remove(decoded[0])
+
+
+# Drop an upload that will not become a session, along with anything decoded from it
+def discard_upload(video_path, ingest=None):
+    os.remove(video_path)
+    if ingest is not None:
+        ingest.cancel()
+        ingest.decoding.add_done_callback(remove_decoded_carrier)
+
+
+def ensure_listener():
+    global server_socket
+    with listener_lock:
+        if server_socket is not None:
+            return
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listen_socket.bind(('localhost', 12345))
+            listen_socket.listen(max_sessions)
+        except OSError:
+            listen_socket.close()
+            raise
+        listen_socket.setblocking(False)
+        server_socket = listen_socket
+        threading.Thread(target=asyncio.run, args=(serve_forever(server_socket),), daemon=True).start()
+        print("Server waiting for connections...")
+
+
+# A session is over: drop the message and the prepared keys and signature,
+# which are no longer needed, and forget the oldest finished sessions beyond
+# keep_finished_sessions. An upload the session owns is deleted; its carrier
+# lives on in the carrier cache.
+def end_session(session):
+    session.message = None
+    session.preparation = None
+    if session.remove_upload and os.path.exists(session.video_path):
+        discard_upload(session.video_path, session.ingest)
+    session.done.set()
+    with sessions_lock:
+        finished = [session_id for session_id, other in sessions.items() if other.done.is_set()]
+        for session_id in finished[:max(len(finished) - keep_finished_sessions, 0)]:
+            del sessions[session_id]
+
+
+# Long-lived accept loop on its own event loop thread. Once max_sessions are
+# in flight it stops accepting, so further clients wait in the kernel backlog.
+# Accept errors such as running out of file descriptors are retried after
+# accept_retry_delay; the loop only ends once the listening socket is closed.
+async def serve_forever(listen_socket):
+    loop = asyncio.get_running_loop()
+    session_slots = asyncio.Semaphore(max_sessions)
+    embed_slots = asyncio.Semaphore(embed_workers + embed_queue_limit)
+    while True:
+        await session_slots.acquire()
+        try:
+            conn, addr = await loop.sock_accept(listen_socket)
+        except OSError as e:
+            session_slots.release()
+            if listen_socket.fileno() == -1:
+                return
+            print(f"Could not accept a connection ({e}), retrying in {accept_retry_delay} s")
+            await asyncio.sleep(accept_retry_delay)
+            continue
+        print(f"Connected by {addr}")
+        conn.setblocking(False)
+        loop.create_task(handle_connection(conn, session_slots, embed_slots))
+
+
+async def handle_connection(conn, session_slots, embed_slots):
+    try:
+        try:
+            session = pending_sessions.get_nowait()
+        except queue.Empty:
+            print("No uploaded video is waiting for a client, closing connection.")
+            return
+        try:
+            await run_session(session, conn, embed_slots)
+            session.trace.finish('complete')
+        except Exception as e:
+            fail_session(session, str(e))
+        finally:
+            end_session(session)
+            upload_slots.release()
+    finally:
+        conn.close()
+        session_slots.release()
+
+
+async def run_session(session, conn, embed_slots):
+    loop = asyncio.get_running_loop()
+    session.progress.set_state('running')
+    trace = session.trace
+
+    try:
+        with trace.stage('handshake'):
+            try:
+                shared_secret1, shared_secret2 = await asyncio.wait_for(exchange_secrets(session, conn),
+                                                                        handshake_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"Client did not complete the key exchange within {handshake_timeout} seconds")
+    except BaseException:
+        session.preparation.add_done_callback(release_preparation)
+        raise
+
+    # Everything that does not depend on the secrets was prepared at upload time
+    with trace.stage('wait_prepare'):
+        prepared = await asyncio.wrap_future(session.preparation)
+    public_key = prepared['public_key']
+
+    # Encode Data into the Targeted Frames on the worker pool. Waits while the
+    # pool and its queue are full.
+    output_video_path = f"output_video_{session.id}.avi"
+    try:
+        with trace.stage('embed_queue'):
+            await embed_slots.acquire()
+        try:
+            await loop.run_in_executor(embed_pool,
+                                       profiler.wrap(session.id, 'embed', session.profiled, embed_prepared),
+                                       prepared, shared_secret1, shared_secret2, output_video_path, session.progress,
+                                       trace)
+        finally:
+            embed_slots.release()
+
+        frame_index = b''
+        if send_frame_index:
+            with trace.stage('frame_index'):
+                frame_index = await loop.run_in_executor(embed_pool, build_frame_index, output_video_path) or b''
+
+        # Send Video to Client
+        encoded_public_key = base64.b64encode(public_key).decode('utf-8')
+
+        # Send the public key to the client
+        with trace.stage('send'):
+            await async_send_message(conn, MSG_PUBLIC_KEY, encoded_public_key.encode())
+            await async_send_message(conn, MSG_FRAME_INDEX, frame_index)
+
+            # Stream video data
+            session.progress.begin('transfer')
+            sent = await async_send_file(conn, MSG_VIDEO, output_video_path,
+                                         progress=session.progress.reporter('transfer'))
+            session.progress.finish('transfer')
+        metrics.count('video_bytes_sent_total', "Embedded video bytes sent to clients", sent)
+    finally:
+        if os.path.exists(output_video_path):
+            os.remove(output_video_path)
+        release_prepared(prepared)
+
+    print(f"Public key and video sent successfully for session {session.id}.")
+    session.processing_complete = True
+    session.progress.set_state('complete')
+
+
+# Two Diffie-Hellman exchanges, for the key frame and the message frame.
+# Returns (shared_secret1, shared_secret2).
+async def exchange_secrets(session, conn):
     # First Diffie-Hellman for Key Frame
     private_key1, public_key1, prime, base = diffie_hellman_exchange()
-    conn.sendall(f"{public_key1}".encode())
-    bob_public1 = int(conn.recv(1024).decode())
+    await async_send_message(conn, MSG_DH_PUBLIC, f"{public_key1}".encode())
+    bob_public1 = int((await async_recv_message(conn, MSG_DH_PUBLIC))[1].decode())
     shared_secret1 = pow(bob_public1, private_key1, prime)
-    shared_secrets['secret1'] = shared_secret1
+    session.shared_secrets['secret1'] = shared_secret1
     print(f"Shared Secret for Key Frame: {shared_secret1}")
 
     # Second Diffie-Hellman for Message Frame
     private_key2, public_key2, _, _ = diffie_hellman_exchange()
-    conn.sendall(f"{public_key2}".encode())
-    bob_public2 = int(conn.recv(1024).decode())
+    await async_send_message(conn, MSG_DH_PUBLIC, f"{public_key2}".encode())
+    bob_public2 = int((await async_recv_message(conn, MSG_DH_PUBLIC))[1].decode())
     shared_secret2 = pow(bob_public2, private_key2, prime)
-    shared_secrets['secret2'] = shared_secret2
+    session.shared_secrets['secret2'] = shared_secret2
     print(f"Shared Secret for Message Frame: {shared_secret2}")
 
     # Ensure Key Frame and Message Frame are not the same
     if shared_secret1 == shared_secret2:
         shared_secret2 += 1
-        shared_secrets['secret2'] = shared_secret2
+        session.shared_secrets['secret2'] = shared_secret2
         print(f"Adjusted Shared Secret for Message Frame: {shared_secret2}")
 
-    # Generate AES Key and Encrypt Message
-    aes_key = get_random_bytes(16)
-    encrypted_message = encrypt_message(message, aes_key)
-    print(f"Encrypted message: {encrypted_message}")
+    return shared_secret1, shared_secret2
 
-    # Convert AES Key to Base64 String
-    encoded_key = base64.b64encode(aes_key).decode('utf-8')
 
-    # Extract Frames and Encode Data
-    frame_folder = "video_frames"
-    frame_count = extract_frames(video_path, frame_folder)
+# The part of a session that needs the shared secrets: place the prepared
+# key, message and signature in their frames and write the output video.
+# Reports the embed and encode stages into `progress` and `trace` when given.
+def embed_prepared(prepared, shared_secret1, shared_secret2, output_video_path, progress=None, trace=None):
+    progress = progress if progress is not None else JobProgress()
+    trace = trace if trace is not None else Trace()
+    progress.begin('embed')
+    frame_count = prepared['frame_count']
 
     key_frame_number = shared_secret1 % frame_count
     message_frame_number = shared_secret2 % frame_count
 
-    private_key, public_key = generate_rsa_keys()
-    signature = create_signature(message, private_key)
+    aes_key = prepared['aes_key']
+    encrypted_message = prepared['encrypted_message']
+    signature = prepared['signature']
+    store = FrameStore(prepared['frame_store']) if prepared.get('frame_store') else None
+
+    # Raw bytes in the binary payload container, no base64 or delimiter
+    payloads = [
+        (key_frame_number, partial(embed_payload, data=aes_key, bits_per_channel=embed_depth)),
+        (message_frame_number, partial(embed_payload, data=encrypted_message, bits_per_channel=embed_depth)),
+        (0, partial(embed_payload, data=signature, bits_per_channel=embed_depth)),
+    ]
+
+    # Messages too large for one frame are sharded across consecutive frames
+    # from the message frame, embedded in parallel ahead of the write
+    replacements = None
+    if len(encrypted_message) > payload_capacity(*prepared['resolution'], embed_depth):
+        with trace.stage('embed_shards'):
+            shards = split_payload(encrypted_message, shard_capacity(*prepared['resolution'], embed_depth))
+            frame_numbers = shard_frames(message_frame_number, len(shards), frame_count,
+                                         reserved={0, key_frame_number})
+            replacements = embed_message_shards(prepared['carrier_path'], frame_numbers, shards,
+                                                prepared.get('frame_store'))
+        payloads = [payloads[0], payloads[2]]
+        print(f"Message split into {len(shards)} shards")
+    progress.finish('embed')
+
+    # The key, message and signature frames are embedded as the video is written
+    progress.begin('encode')
+    with trace.stage('encode'):
+        frame_count = embed_video(prepared['carrier_path'], output_video_path, payloads, splice_mode, replacements,
+                                  progress=progress.reporter('encode'), store=store)
+    progress.finish('encode')
+    return frame_count
 
-    encode_image(os.path.join(frame_folder, f"frame{key_frame_number}.png"), encoded_key,
-                 os.path.join(frame_folder, f"frame{key_frame_number}.png"))
-    encode_image(os.path.join(frame_folder, f"frame{message_frame_number}.png"), encrypted_message,
-                 os.path.join(frame_folder, f"frame{message_frame_number}.png"))
-    
-    encode_image(os.path.join(frame_folder, f"frame{0}.png"), signature, os.path.join(frame_folder, f"frame{0}.png"))
 
-    # Convert Frames Back to Video
-    output_video_path = "output_video.avi"
-    fps, _, resolution = get_video_properties(video_path)
-    frames_to_video(frame_folder, output_video_path, fps, frame_count, resolution)
+def embed_message_shards(carrier_path, frame_numbers, shards, store_path=None):
+    if store_path is not None:
+        embedded = embed_store_shards(store_path, frame_numbers, shards, bits_per_channel=embed_depth, pool=shard_pool)
+        return dict(zip(frame_numbers, embedded))
+    frames = read_frames_at(carrier_path, frame_numbers)
+    embedded = embed_shards([frames[frame_number] for frame_number in frame_numbers], shards,
+                            bits_per_channel=embed_depth, pool=shard_pool)
+    return dict(zip(frame_numbers, embedded))
 
-    # Send Video to Client
-    encoded_public_key = base64.b64encode(public_key).decode('utf-8')
 
-    # Send the public key to the client
-    conn.sendall(f"PUBLIC_KEY:{encoded_public_key}".encode())
+metrics.gauge('pending_sessions', "Uploads waiting for a client to connect", pending_sessions.qsize)
+metrics.gauge('key_pool_depth', "Pre-generated RSA keys ready", lambda: key_pool.stats()['depth'])
+metrics.gauge('carrier_cache_bytes', "Bytes held by the carrier cache", lambda: carrier_cache.stats()['bytes'])
+metrics.gauge('carrier_cache_hit_rate', "Carrier cache hits over lookups", lambda: carrier_cache.stats()['hit_rate'])
 
-    # Introduce a small delay to avoid overlapping data
-    import time
-    time.sleep(1)
 
-    # Send video data
-    with open(output_video_path, 'rb') as f:
-        video_data = f.read()
-        conn.sendall(video_data)
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-    conn.close()
-    print("Public key and video sent successfully.")
 
-    conn.close()
-    server_socket.close()
-    print("Video sent successfully.")
-    processing_complete = True
+@app.route('/traces')
+def list_traces():
+    return jsonify(metrics.traces())
+
+
+@app.route('/traces/<trace_id>')
+def trace_record(trace_id):
+    trace = metrics.get_trace(trace_id)
+    if trace is None:
+        return jsonify({'error': 'Unknown trace'}), 404
+    return jsonify(trace.to_dict())
+
+
+@app.route('/keypool')
+def keypool_stats():
+    return jsonify(key_pool.stats())
+
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(carrier_cache.stats())
+
+
+def job_record(session):
+    return {'id': session.id, 'shared_secrets': session.shared_secrets, **session.progress.snapshot()}
+
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([job_record(session) for session in list(sessions.values())])
+
+
+@app.route('/jobs/<session_id>')
+def job_status(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_record(session))
+
+
+# Server-Sent Events: one event per progress change until the job finishes,
+# with a comment line every 15 seconds to keep idle connections open
+@app.route('/jobs/<session_id>/events')
+def job_events(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def stream():
+        version = None
+        while True:
+            record = job_record(session)
+            if record['version'] != version:
+                version = record['version']
+                yield f"data: {json.dumps(record)}\n\n"
+            if session.progress.finished:
+                return
+            if session.progress.wait(version, timeout=15) == version:
+                yield ": keepalive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
-    global shared_secrets, processing_complete, server_socket
     if request.method == 'POST':
         if 'file' not in request.files:
             return 'No file part'
@@ -219,15 +774,54 @@ def upload_file():
         message = request.form['message']
         if file.filename == '':
             return 'No selected file'
+
+        # A streamed upload is already on disk and being decoded
+        ingest = file.stream if isinstance(file.stream, IngestFile) else None
+        if ingest is not None:
+            request.claim_ingest(ingest)
+            ingest.finish()
+            if not message:
+                discard_upload(ingest.path, ingest)
+
         if file and message:
-            video_path = os.path.join('uploads', file.filename)
-            file.save(video_path)
-            shared_secrets = {'secret1': None, 'secret2': None}
-            processing_complete = False
-            if server_socket:
-                server_socket.close()
-            threading.Thread(target=start_server, args=(video_path, message)).start()
-            return 'File uploaded and processing started. Please wait for the shared secrets to be generated.'
+            if ingest is not None:
+                video_path = ingest.path
+            else:
+                upload_id = uuid.uuid4().hex[:12]
+                video_path = os.path.join('uploads', f"{upload_id}_{file.filename}")
+                file.save(video_path)
+
+            # Reject messages that cannot fit before doing any expensive work
+            try:
+                fits, needed, available = check_message_fits(video_path, message, bits_per_channel=embed_depth,
+                                                             frame_budget=max_message_frames)
+            except Exception as e:
+                discard_upload(video_path, ingest)
+                metrics.count('uploads_total', "Uploads by outcome", outcome='unreadable')
+                return f'Could not read video: {e}', 400
+            if not fits:
+                discard_upload(video_path, ingest)
+                metrics.count('uploads_total', "Uploads by outcome", outcome='too_large')
+                return f'Message too large: needs {needed} bytes, this video can carry {available} bytes', 413
+
+            try:
+                session = start_server(video_path, message, ingest, remove_upload=True)
+            except ServerBusy as e:
+                discard_upload(video_path, ingest)
+                metrics.count('uploads_total', "Uploads by outcome", outcome='busy')
+                return str(e), 503
+            metrics.count('uploads_total', "Uploads by outcome", outcome='accepted')
+            return (f'File uploaded and processing started (session {session.id}). '
+                    f'Please wait for the shared secrets to be generated: <a href="/?session={session.id}">status</a> '
+                    f'(progress: <a href="/jobs/{session.id}">/jobs/{session.id}</a>)')
+
+    session = sessions.get(request.args.get('session', ''))
+    if session is None and sessions:
+        session = list(sessions.values())[-1]
+    shared_secrets = session.shared_secrets if session else {'secret1': None, 'secret2': None}
+    processing_complete = session.processing_complete if session else False
+    error = session.error if session else None
+    stages = session.progress.snapshot()['stages'] if session else {}
 
     return render_template_string('''
     <!doctype html>
@@ -403,7 +997,8 @@ def upload_file():
                 <h2>Shared Secrets</h2>
                 <p>Secret 1: <span id="secret1">{{ shared_secrets['secret1'] or 'Not generated yet' }}</span></p>
                 <p>Secret 2: <span id="secret2">{{ shared_secrets['secret2'] or 'Not generated yet' }}</span></p>
-                <p>Status: <span id="status">{{ 'Processing complete' if processing_complete else 'Processing...' }}</span></p>
+                <p>Status: <span id="status">{{ 'Processing complete' if processing_complete else ('Failed: ' ~ error if error else 'Processing...') }}</span></p>
+                <p>Stages: <span id="stages">{% for stage, info in stages.items() %}{{ stage }} {{ (info['progress'] * 100) | round | int }}%{{ ', ' if not loop.last }}{% else %}-{% endfor %}</span></p>
                 <button id="refreshButton" onclick="refreshSecrets()">Refresh Status</button>
             </div>
         </div>
@@ -460,7 +1055,7 @@ def upload_file():
                         const parser = new DOMParser();
                         const doc = parser.parseFromString(html, 'text/html');
 
-                        ['secret1', 'secret2', 'status'].forEach(id => {
+                        ['secret1', 'secret2', 'status', 'stages'].forEach(id => {
                             const element = document.getElementById(id);
                             const newValue = doc.getElementById(id).textContent;
                             if (element.textContent !== newValue) {
@@ -480,7 +1075,7 @@ def upload_file():
         </script>
     </body>
     </html>
-    ''', shared_secrets=shared_secrets, processing_complete=processing_complete)
+    ''', shared_secrets=shared_secrets, processing_complete=processing_complete, error=error, stages=stages)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lsb import embed_data
+
+
+# Original per-pixel implementation, kept here as the reference for both
+# correctness (bit-for-bit output) and speed
+def legacy_encode_image(image_path, data, output_path):
+    image = Image.open(image_path)
+    encoded_image = image.copy()
+
+    width, height = image.size
+    data += "###"  # Delimiter to indicate the end
+    data_bits = "".join([format(ord(char), '08b') for char in data])
+
+    bit_index = 0
+    for x in range(width):
+        for y in range(height):
+            pixel = list(encoded_image.getpixel((x, y)))
+            for i in range(3):  # RGB
+                if bit_index < len(data_bits):
+                    pixel[i] = pixel[i] & ~1 | int(data_bits[bit_index])
+                    bit_index += 1
+            encoded_image.putpixel((x, y), tuple(pixel))
+            if bit_index >= len(data_bits):
+                break
+        if bit_index >= len(data_bits):
+            break
+
+    encoded_image.save(output_path)
+
+
+def vectorized_encode_image(image_path, data, output_path):
+    frame = np.array(Image.open(image_path))
+    encoded_frame = embed_data(frame, data + "###", channel_order='rgb', in_place=True)
+    Image.fromarray(encoded_frame).save(output_path)
+
+
+def time_call(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy and vectorized LSB embedders")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--payload', type=int, default=4096, help="payload size in characters")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    payload = "".join(chr(c) for c in rng.integers(65, 91, args.payload))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'frame.png')
+        legacy_out = os.path.join(tmp, 'legacy.png')
+        vector_out = os.path.join(tmp, 'vector.png')
+        Image.fromarray(frame).save(source)
+
+        legacy = time_call(legacy_encode_image, source, payload, legacy_out, repeat=args.repeat)
+        vector = time_call(vectorized_encode_image, source, payload, vector_out, repeat=args.repeat)
+
+        identical = np.array_equal(np.array(Image.open(legacy_out)), np.array(Image.open(vector_out)))
+
+    print(f"Frame {args.width}x{args.height}, payload {args.payload} chars")
+    print(f"legacy:     {legacy * 1000:.1f} ms")
+    print(f"vectorized: {vector * 1000:.1f} ms ({legacy / vector:.1f}x)")
+    print(f"bit-for-bit identical: {identical}")
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+# End-to-end benchmark of the embedding pipeline over synthetic carrier
+# videos. Every stage is timed on each generated video (best of --repeat
+# runs) along with the peak resident set size seen while it ran, and the
+# results are written as JSON so runs on different commits can be compared:
+#
+#   python benchmarks/bench_pipeline.py --output before.json
+#   python benchmarks/bench_pipeline.py --output after.json --compare before.json
+#
+# The server and client modules create their working directories relative to
+# the current directory, so everything runs inside a scratch directory.
+
+SIZES = {'480p': (854, 480), '1080p': (1920, 1080), '4k': (3840, 2160)}
+
+
+# Smooth moving gradients with a little noise: compresses like real footage
+# rather than like white noise, and is the same on every run
+def synthetic_frames(width, height, frame_count, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    for index in range(frame_count):
+        shift = index * 4
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + shift) % 256
+        frame[..., 1] = (y + shift) % 256
+        frame[..., 2] = ((x + y) / 2 + shift) % 256
+        noise = rng.integers(0, 4, (height, width, 1), dtype=np.uint8)
+        yield frame | noise
+
+
+def generate_video(path, width, height, frame_count, fps=25):
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'FFV1'), fps, (width, height))
+    try:
+        for frame in synthetic_frames(width, height, frame_count):
+            out.write(frame)
+    finally:
+        out.release()
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Lifetime peak, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Samples this process's RSS on a background thread while a stage runs.
+# Worker processes (shard pool) are not included.
+class PeakRss:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+# Best time and highest peak RSS over `repeat` runs of func()
+def measure(func, repeat):
+    best, peak = float('inf'), 0
+    for _ in range(repeat):
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        peak = max(peak, rss.peak)
+    return best, peak
+
+
+def record(results, video, stage, seconds, peak_rss, frames=None, payload_bytes=None):
+    entry = {
+        'video': video,
+        'stage': stage,
+        'seconds': round(seconds, 6),
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+        'frames_per_s': round(frames / seconds, 2) if frames else None,
+        'payload_bytes_per_s': round(payload_bytes / seconds, 1) if payload_bytes else None,
+    }
+    results.append(entry)
+    throughput = ', '.join(f"{value} {key[:-6].replace('_', ' ')}/s" for key, value in entry.items()
+                           if key.endswith('_per_s') and value is not None)
+    print(f"  {stage:<18} {seconds * 1000:10.1f} ms  {entry['peak_rss_mb']:8.1f} MB  {throughput}")
+
+
+def run_video(label, path, resolution, frame_count, message, repeat, results):
+    import VSserver
+    import VSClient
+    from payload import embed_payload
+    from video_io import read_frames_at, prepare_carrier, embed_video
+
+    width, height = resolution
+    payload = message.encode()
+
+    # Single-frame LSB stages on a PNG of the first frame
+    frame = next(synthetic_frames(width, height, 1))
+    cv2.imwrite('frame.png', frame)
+    seconds, peak = measure(lambda: VSserver.encode_image('frame.png', message, 'encoded.png'), repeat)
+    record(results, label, 'encode_image', seconds, peak, frames=1, payload_bytes=len(payload))
+
+    encoded = embed_payload(frame.copy(), payload)
+    seconds, peak = measure(lambda: VSClient.decode_image(encoded), repeat)
+    record(results, label, 'decode_image', seconds, peak, frames=1, payload_bytes=len(payload))
+
+    # Legacy PNG round trip
+    seconds, peak = measure(lambda: VSserver.extract_frames(path, 'frames'), repeat)
+    record(results, label, 'extract_frames', seconds, peak, frames=frame_count)
+
+    seconds, peak = measure(lambda: VSserver.frames_to_video('frames', 'rebuilt.avi', 25, frame_count,
+                                                             (width, height)), repeat)
+    record(results, label, 'frames_to_video', seconds, peak, frames=frame_count)
+
+    # Streaming pipeline
+    targets = [0, frame_count // 2, frame_count - 1]
+    seconds, peak = measure(lambda: read_frames_at(path, targets), repeat)
+    record(results, label, 'extract_frame', seconds, peak, frames=len(targets))
+
+    seconds, peak = measure(lambda: prepare_carrier(path, 'carrier.avi'), repeat)
+    record(results, label, 'prepare_carrier', seconds, peak, frames=frame_count)
+
+    carrier = 'carrier.avi' if os.path.exists('carrier.avi') else path
+    payloads = [(frame_number, payload) for frame_number in targets]
+    for stage, splice in (('embed_splice', True), ('embed_full', False)):
+        seconds, peak = measure(lambda: embed_video(carrier, 'embedded.avi', payloads, splice=splice), repeat)
+        record(results, label, stage, seconds, peak, frames=frame_count, payload_bytes=len(payload) * len(targets))
+
+    # Loopback session: upload, handshake, embed, transfer and extraction.
+    # The first run decodes the carrier, later ones hit the carrier cache.
+    def session():
+        upload = VSserver.start_server(path, message)
+        _, _, video_path = VSClient.start_client()
+        upload.done.wait()
+        if upload.error:
+            raise RuntimeError(upload.error)
+        # The server's secrets, which account for its key/message frame collision adjustment
+        secrets = upload.shared_secrets
+        decrypted, valid, _ = VSClient.decrypt_video(secrets['secret1'], secrets['secret2'], video_path)
+        if decrypted != message or not valid:
+            raise RuntimeError("Loopback session did not recover the message")
+
+    seconds, peak = measure(session, 1)
+    record(results, label, 'session_cold', seconds, peak, frames=frame_count, payload_bytes=len(payload))
+    if repeat > 1:
+        seconds, peak = measure(session, repeat - 1)
+        record(results, label, 'session_warm', seconds, peak, frames=frame_count, payload_bytes=len(payload))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(entry['video'], entry['stage']): entry for entry in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path} (time ratio, < 1 is faster):")
+    for entry in results:
+        before = baseline.get((entry['video'], entry['stage']))
+        if before is not None and before['seconds']:
+            print(f"  {entry['video']:<12} {entry['stage']:<18} {entry['seconds'] / before['seconds']:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage over synthetic videos")
+    parser.add_argument('--sizes', default='480p,1080p', help=f"comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument('--lengths', default='30,90', help="comma-separated frame counts (at least 23)")
+    parser.add_argument('--message', type=int, default=1024, help="message size in characters")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_pipeline.json', help="JSON results file")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--with-preview', action='store_true', help="also build MP4 previews on the client")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    lengths = [int(length) for length in args.lengths.split(',')]
+    if min(lengths) < 23:
+        # Shared secrets go up to 22 and are used as frame numbers
+        parser.error("--lengths must all be at least 23 frames")
+    message = ''.join(chr(c) for c in np.random.default_rng(0).integers(65, 91, args.message))
+
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        os.makedirs('uploads')
+        import VSserver
+        import VSClient
+        if not args.with_preview:
+            VSClient.preview_cache.stream_command = None
+            VSClient.preview_cache.convert = lambda input_path, output_path: None
+
+        # Fill the RSA key pool first so key generation does not run during timings
+        VSserver.key_pool.start()
+        while VSserver.key_pool.stats()['depth'] < VSserver.key_pool.size:
+            time.sleep(0.1)
+
+        for size in args.sizes.split(','):
+            width, height = SIZES[size]
+            for length in lengths:
+                label = f"{size}x{length}"
+                path = os.path.join(scratch, f"{label}.avi")
+                start = time.perf_counter()
+                generate_video(path, width, height, length)
+                print(f"{label}: generated {width}x{height}, {length} frames in {time.perf_counter() - start:.1f} s")
+                run_video(label, path, (width, height), length, message, args.repeat, results)
+        os.chdir(REPO)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pyav': VSserver.av is not None,
+        'message_chars': args.message,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
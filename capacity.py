@@ -0,0 +1,42 @@
+from payload import payload_capacity
+from sharding import shard_capacity
+from video_io import probe_video, count_frames
+
+# Capacity planning from container metadata alone, so an upload can be
+# rejected before anything is decoded or encrypted.
+
+AES_BLOCK_SIZE = 16
+SIGNATURE_SIZE = 256  # RSA-2048 PKCS#1 v1.5
+RESERVED_FRAMES = 2  # Frame 0 carries the signature, one frame carries the AES key
+
+
+# Size of the AES-CBC ciphertext (IV + PKCS#7 padded data) for a message
+def encrypted_size(message_length):
+    return AES_BLOCK_SIZE + (message_length // AES_BLOCK_SIZE + 1) * AES_BLOCK_SIZE
+
+
+# Largest encrypted message (in bytes) that fits, given the embedding depth
+# and how many frames the message may be spread over (default: all of them)
+def max_payload_size(probe, bits_per_channel=1, frame_budget=None):
+    single_frame = payload_capacity(probe['width'], probe['height'], bits_per_channel)
+    if single_frame < SIGNATURE_SIZE:
+        return 0
+
+    frames = probe['frame_count'] - RESERVED_FRAMES
+    if frame_budget is not None:
+        frames = min(frames, frame_budget)
+    if frames <= 0:
+        return 0
+    if frames == 1:
+        return single_frame
+    return max(single_frame, frames * shard_capacity(probe['width'], probe['height'], bits_per_channel))
+
+
+# Returns (fits, needed_bytes, available_bytes) for a message and a video
+def check_message_fits(video_path, message, bits_per_channel=1, frame_budget=None):
+    probe = probe_video(video_path)
+    if probe['frame_count'] <= 0:
+        probe['frame_count'] = count_frames(video_path)
+    needed = encrypted_size(len(message.encode()))
+    available = max_payload_size(probe, bits_per_channel, frame_budget)
+    return needed <= available, needed, available
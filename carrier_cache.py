@@ -0,0 +1,134 @@
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Content-addressed, disk-backed cache of prepared carriers. Uploads are
+# keyed by the SHA-256 of their bytes; each entry is the decoded,
+# spliceable carrier video (<digest>.avi) plus its probed metadata
+# (<digest>.json), and any other files named <digest>.* that were stored
+# next to it (e.g. a frame store) and counted with refresh(). Total size
+# is bounded and the least recently used entries are evicted first.
+# Entries in use by a session are pinned and never evicted under it.
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CarrierCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # digest -> size in bytes, least recent first
+        self._pins = collections.Counter()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        sizes = collections.Counter()
+        for name in os.listdir(directory):
+            digest, ext = os.path.splitext(name)
+            sizes[name.split('.', 1)[0]] += os.path.getsize(os.path.join(directory, name))
+            video_path = os.path.join(directory, digest + '.avi')
+            if ext == '.json' and os.path.exists(video_path):
+                found.append((os.path.getmtime(video_path), digest))
+        for _, digest in sorted(found):
+            self._entries[digest] = sizes[digest]
+
+    def video_path(self, digest):
+        return os.path.join(self.directory, digest + '.avi')
+
+    def _meta_path(self, digest):
+        return os.path.join(self.directory, digest + '.json')
+
+    # Where to keep another file belonging to an entry, e.g. suffix '.frames'
+    def sidecar_path(self, digest, suffix):
+        return os.path.join(self.directory, digest + suffix)
+
+    def _files(self, digest):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.split('.', 1)[0] == digest]
+
+    # Re-measure an entry after files were added next to it
+    def refresh(self, digest):
+        size = sum(os.path.getsize(path) for path in self._files(digest) if os.path.exists(path))
+        with self._lock:
+            if digest in self._entries:
+                self._entries[digest] = size
+                self._evict()
+
+    # Look up and pin an entry. Returns (video_path, metadata) or None on a miss.
+    def acquire(self, digest):
+        with self._lock:
+            if digest not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(digest)
+            self._pins[digest] += 1
+        with open(self._meta_path(digest)) as f:
+            metadata = json.load(f)
+        os.utime(self.video_path(digest))
+        return self.video_path(digest), metadata
+
+    # Add a carrier and pin it. With move=True the source file is taken over.
+    def put(self, digest, source_path, metadata, move=False):
+        video_path = self.video_path(digest)
+        temp_path = video_path + '.tmp'
+        if move:
+            shutil.move(source_path, temp_path)
+        else:
+            shutil.copyfile(source_path, temp_path)
+        with open(self._meta_path(digest), 'w') as f:
+            json.dump(metadata, f)
+        os.replace(temp_path, video_path)
+
+        with self._lock:
+            self._entries[digest] = os.path.getsize(video_path)
+            self._entries.move_to_end(digest)
+            self._pins[digest] += 1
+            self._evict()
+        return video_path
+
+    def release(self, digest):
+        with self._lock:
+            self._pins[digest] -= 1
+            if self._pins[digest] <= 0:
+                del self._pins[digest]
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(self._entries.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        for digest in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if self._pins[digest]:
+                continue
+            total -= self._entries.pop(digest)
+            for path in self._files(digest):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.evictions += 1
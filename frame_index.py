@@ -0,0 +1,106 @@
+import os
+import struct
+
+from video_io import av
+
+# Frame -> packet index of an intra-only video, sent by the server with the
+# video so the client can decode any frame from its packet alone, without
+# opening the container or seeking through it:
+#
+#   magic (4) | version (1) | file size (8) | width (4) | height (4)
+#   | frame count (4) | extradata length (4) | codec (16) | pix_fmt (16)
+#   | extradata | frame count x (byte offset (8), packet size (4))
+#
+# The file size ties the index to the exact file it was built from; an index
+# that does not match is ignored and the caller reads frames the usual way.
+# The client keeps it next to the video as <video>.idx.
+
+INDEX_MAGIC = b'VSFI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('!4sBQIIII16s16s')
+INDEX_ENTRY = struct.Struct('!QI')
+
+
+class FrameIndexError(Exception):
+    pass
+
+
+# Index of a written video, from one demux pass without decoding. Returns
+# None without PyAV or when a frame depends on another one.
+def build_frame_index(video_path):
+    if av is None:
+        return None
+    entries = []
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        codec = stream.codec_context
+        for packet in container.demux(stream):
+            if packet.dts is None:
+                continue
+            if not packet.is_keyframe or packet.pos is None or packet.pos < 0:
+                return None
+            entries.append(INDEX_ENTRY.pack(packet.pos, packet.size))
+        extradata = bytes(codec.extradata or b'')
+        header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, os.path.getsize(video_path), codec.width,
+                                   codec.height, len(entries), len(extradata), codec.name.encode(),
+                                   codec.pix_fmt.encode())
+    return header + extradata + b''.join(entries)
+
+
+def index_path(video_path):
+    return video_path + '.idx'
+
+
+# The index stored next to a video, or None if there is none that matches it
+def load_frame_index(video_path):
+    if av is None:
+        return None
+    try:
+        with open(index_path(video_path), 'rb') as f:
+            index = FrameIndex(f.read())
+    except (OSError, FrameIndexError):
+        return None
+    return index if index.matches(video_path) else None
+
+
+class FrameIndex:
+    def __init__(self, data):
+        if len(data) < INDEX_HEADER.size:
+            raise FrameIndexError("Frame index is truncated")
+        (magic, version, self.file_size, self.width, self.height, self.frame_count, extradata_length, codec,
+         pix_fmt) = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise FrameIndexError("Not a frame index")
+        self.codec = codec.rstrip(b'\0').decode()
+        self.pix_fmt = pix_fmt.rstrip(b'\0').decode()
+        start = INDEX_HEADER.size + extradata_length
+        self.extradata = bytes(data[INDEX_HEADER.size:start])
+        if len(data) != start + self.frame_count * INDEX_ENTRY.size:
+            raise FrameIndexError("Frame index is truncated")
+        self.entries = list(INDEX_ENTRY.iter_unpack(data[start:]))
+
+    def matches(self, video_path):
+        return os.path.getsize(video_path) == self.file_size
+
+    # Decode the given frames straight from their packets.
+    # Returns {frame_number: frame} for the frames in range.
+    def read_frames(self, video_path, frame_numbers):
+        decoder = av.CodecContext.create(self.codec, 'r')
+        decoder.width = self.width
+        decoder.height = self.height
+        decoder.pix_fmt = self.pix_fmt
+        if self.extradata:
+            decoder.extradata = self.extradata
+
+        frames = {}
+        with open(video_path, 'rb') as f:
+            for frame_number in sorted(set(frame_numbers)):
+                if not 0 <= frame_number < self.frame_count:
+                    print(f"Frame number {frame_number} exceeds total frames ({self.frame_count})")
+                    continue
+                offset, size = self.entries[frame_number]
+                f.seek(offset)
+                decoded = decoder.decode(av.Packet(f.read(size)))
+                if decoded:
+                    frames[frame_number] = decoded[0].to_ndarray(format='bgr24')
+        return frames
@@ -0,0 +1,102 @@
+import json
+import os
+import uuid
+
+import numpy as np
+
+# Decoded frames kept on disk as one flat file of fixed-stride uint8 frames,
+# memory-mapped so any frame is a zero-copy view. The index next to it,
+# <path>.json, records the layout:
+#
+#   {"frame_count", "width", "height", "channels", "stride", "fps"}
+#
+# Frame i starts at byte i * stride. Opened read-only the mapping is backed
+# by the page cache, so worker processes that open the same store share its
+# pages instead of being sent pickled frames. Opened with mode 'r+' frames
+# can be modified in place; flush() writes them back. Frames are written
+# out front to back, so feeding frames() to an encoder is one sequential pass.
+
+
+class FrameStoreError(Exception):
+    pass
+
+
+def index_path(path):
+    return path + '.json'
+
+
+def remove_store(path):
+    for file_path in (index_path(path), path):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+class FrameStore:
+    def __init__(self, path, mode='r'):
+        try:
+            with open(index_path(path)) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            raise FrameStoreError(f"No readable frame store index for {path}: {e}")
+        self.path = path
+        self.fps = index['fps']
+        self.resolution = (index['width'], index['height'])
+        shape = (index['frame_count'], index['height'], index['width'], index['channels'])
+        if index['stride'] != index['height'] * index['width'] * index['channels']:
+            raise FrameStoreError(f"Frame store {path} has an unsupported stride")
+        if shape[0] == 0:
+            self._frames = np.empty(shape, dtype=np.uint8)
+        else:
+            self._frames = np.memmap(path, dtype=np.uint8, mode=mode, shape=shape)
+
+    # Write frames front to back into a new store at `path` and open it.
+    # Both files are written aside and moved into place, index last, so a
+    # reader never sees a partial store.
+    @classmethod
+    def create(cls, path, frames, fps, resolution, channels=3):
+        width, height = resolution
+        stride = width * height * channels
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        frame_count = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for frame in frames:
+                    if frame.shape != (height, width, channels) or frame.dtype != np.uint8:
+                        raise FrameStoreError(f"Frame {frame_count} is {frame.shape} {frame.dtype}, expected "
+                                              f"({height}, {width}, {channels}) uint8")
+                    f.write(np.ascontiguousarray(frame).data)
+                    frame_count += 1
+            with open(temp_path + '.json', 'w') as f:
+                json.dump({'frame_count': frame_count, 'width': width, 'height': height, 'channels': channels,
+                           'stride': stride, 'fps': fps}, f)
+            os.replace(temp_path, path)
+            os.replace(temp_path + '.json', index_path(path))
+        finally:
+            for file_path in (temp_path, temp_path + '.json'):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        return cls(path)
+
+    def __len__(self):
+        return len(self._frames)
+
+    # A view into the mapping; read-only unless the store was opened 'r+'
+    def __getitem__(self, frame_number):
+        return self._frames[frame_number]
+
+    # {frame_number: frame} for the frames in range, like video_io.read_frames_at
+    def read(self, frame_numbers):
+        return {frame_number: self._frames[frame_number] for frame_number in set(frame_numbers)
+                if 0 <= frame_number < len(self._frames)}
+
+    # Every frame in order. Frames in `copies` are yielded as writable copies,
+    # for embedding into without touching the store.
+    def frames(self, copies=()):
+        for frame_number in range(len(self._frames)):
+            frame = self._frames[frame_number]
+            yield frame.copy() if frame_number in copies else frame
+
+    def flush(self):
+        if isinstance(self._frames, np.memmap):
+            self._frames.flush()
+
@@ -0,0 +1,137 @@
+import hashlib
+import threading
+
+# Streamed upload ingestion. The upload's file part is written straight to
+# its final path under uploads/ as the request body arrives, hashing it on
+# the way, and readers can follow the file while it is still growing.
+# VSserver hands an IngestFile to werkzeug as the part's stream and starts
+# decoding from open_reader() at once, so decoding overlaps the upload
+# instead of waiting for file.save() and a second read from disk.
+
+
+class IngestError(Exception):
+    pass
+
+
+class IngestFile:
+    def __init__(self, path, idle_timeout=60):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.size = 0
+        self.complete = False
+        self.failed = False
+        self.cancelled = False
+        self.decoding = None  # Future for the decode started on the stream, if any
+        self.decoded = 0.0  # Fraction of the video that decode has got through
+        self.on_decoded = None  # Called with `decoded` as it advances, once someone watches it
+        self._file = open(path, 'wb')
+        self._hash = hashlib.sha256()
+        self._changed = threading.Condition()
+
+    # Write side, called by werkzeug's multipart parser
+    def write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        self._hash.update(data)
+        with self._changed:
+            self.size += len(data)
+            self._changed.notify_all()
+        return len(data)
+
+    # The parser rewinds the stream once the part is complete; the data is
+    # read back through open_reader(), so there is nothing to move
+    def seek(self, offset, whence=0):
+        return self.size
+
+    def tell(self):
+        return self.size
+
+    def finish(self):
+        with self._changed:
+            if not self.complete:
+                self._file.close()
+                self.complete = True
+                self._changed.notify_all()
+
+    # A request that ends before the part was completed; readers stop at once
+    def close(self):
+        with self._changed:
+            interrupted = not self.complete
+            if interrupted:
+                self.failed = True
+        self.finish()
+        if interrupted:
+            self.cancel()
+
+    # Nobody needs what is read from the upload any more (it was rejected,
+    # or its carrier was cached): readers fail on their next read
+    def cancel(self):
+        with self._changed:
+            self.cancelled = True
+            self._changed.notify_all()
+
+    # Progress callback for the decode reading this upload. The decode
+    # starts before there is a session to report to, so the latest fraction
+    # is kept for whoever sets on_decoded later.
+    def report_decoded(self, fraction):
+        self.decoded = fraction
+        on_decoded = self.on_decoded
+        if on_decoded is not None:
+            on_decoded(fraction)
+
+    # SHA-256 of the whole upload, available once it is complete
+    @property
+    def digest(self):
+        if not self.complete or self.failed:
+            raise IngestError("Upload is not complete")
+        return self._hash.hexdigest()
+
+    # Block until more than `position` bytes have arrived or the upload is
+    # over. Returns the bytes available.
+    def wait_for(self, position):
+        with self._changed:
+            arrived = self._changed.wait_for(lambda: self.size > position or self.complete or self.cancelled,
+                                             self.idle_timeout)
+            if self.cancelled:
+                raise IngestError("Upload was cancelled")
+            if not arrived:
+                raise IngestError(f"No upload data for {self.idle_timeout} seconds")
+            if self.failed:
+                raise IngestError("Upload was interrupted")
+            return self.size
+
+    def open_reader(self):
+        return IngestReader(self)
+
+
+# Read side: a non-seekable file object that blocks until the bytes it is
+# asked for have arrived, and reports end of file only once the upload is
+# complete. Demuxers that need to seek (e.g. MP4 with the index at the end)
+# fail on it, and the caller falls back to the finished file.
+class IngestReader:
+    def __init__(self, ingest):
+        self._ingest = ingest
+        self._file = open(ingest.path, 'rb')
+        self._position = 0
+
+    def seekable(self):
+        return False
+
+    def read(self, n=-1):
+        available = self._ingest.wait_for(self._position)
+        if n is None or n < 0:
+            while not self._ingest.complete:
+                available = self._ingest.wait_for(available)
+            n = available - self._position
+        data = self._file.read(min(n, available - self._position))
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
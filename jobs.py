@@ -0,0 +1,90 @@
+import threading
+import time
+
+# Per-session progress, shared between the worker threads doing the work and
+# the Flask handlers reporting it. A session moves through
+#
+#   queued -> running -> complete | failed
+#
+# and its work is split into the stages below, each with a fraction done and
+# the time it took. Every change bumps `version` and wakes anyone waiting in
+# wait(), which is what the Server-Sent Events stream blocks on.
+
+STAGES = ('decode', 'embed', 'encode', 'transfer')
+
+# Smallest change in a stage's progress worth waking the watchers for
+PROGRESS_STEP = 0.01
+
+
+class JobProgress:
+    def __init__(self):
+        self.state = 'queued'
+        self.error = None
+        self.version = 0
+        self._stages = {stage: {'state': 'pending', 'progress': 0.0, 'seconds': None} for stage in STAGES}
+        self._started = {}
+        self._changed = threading.Condition()
+
+    def _bump(self):
+        self.version += 1
+        self._changed.notify_all()
+
+    def set_state(self, state, error=None):
+        with self._changed:
+            self.state = state
+            self.error = error
+            self._bump()
+
+    def begin(self, stage):
+        with self._changed:
+            self._started[stage] = time.perf_counter()
+            self._stages[stage]['state'] = 'running'
+            self._bump()
+
+    def update(self, stage, fraction):
+        with self._changed:
+            fraction = min(1.0, max(0.0, fraction))
+            if fraction - self._stages[stage]['progress'] >= PROGRESS_STEP:
+                self._stages[stage]['progress'] = fraction
+                self._bump()
+
+    def finish(self, stage):
+        with self._changed:
+            entry = self._stages[stage]
+            entry['state'] = 'done'
+            entry['progress'] = 1.0
+            entry['seconds'] = round(time.perf_counter() - self._started.get(stage, time.perf_counter()), 3)
+            self._bump()
+
+    # Mark stages still running as failed, e.g. when the session errors out
+    def fail_running(self):
+        with self._changed:
+            for entry in self._stages.values():
+                if entry['state'] == 'running':
+                    entry['state'] = 'failed'
+            self._bump()
+
+    # Callback reporting progress(fraction) into a stage, for video_io/protocol
+    def reporter(self, stage):
+        return lambda fraction: self.update(stage, fraction)
+
+    def snapshot(self):
+        with self._changed:
+            now = time.perf_counter()
+            stages = {}
+            for stage, entry in self._stages.items():
+                stages[stage] = dict(entry)
+                if entry['state'] == 'running':
+                    stages[stage]['seconds'] = round(now - self._started[stage], 3)
+            return {'state': self.state, 'error': self.error, 'version': self.version, 'stages': stages}
+
+    @property
+    def finished(self):
+        return self.state in ('complete', 'failed')
+
+    # Block until the version moves past `version` or the timeout expires.
+    # Returns the current version.
+    def wait(self, version, timeout=None):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
@@ -0,0 +1,81 @@
+import collections
+import threading
+import time
+
+# Pool of pre-generated RSA keypairs so sessions never wait on RSA.generate.
+# A background thread keeps the pool topped up to `size`; keys older than
+# `key_lifetime` seconds are rotated out and replaced. Every keypair is
+# handed out at most once.
+
+
+class KeyPool:
+    def __init__(self, generate, size=8, key_lifetime=3600):
+        self.generate = generate
+        self.size = size
+        self.key_lifetime = key_lifetime
+        self._keys = collections.deque()  # (created_at, private_key, public_key), oldest first
+        self._lock = threading.Condition()
+        self._thread = None
+
+        # Metrics
+        self.generated = 0
+        self.served = 0
+        self.empty_hits = 0  # get() found nothing usable and generated inline
+        self.expired = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.size > 0:
+                self._thread = threading.Thread(target=self._refill, name='keypool', daemon=True)
+                self._thread.start()
+
+    def get(self):
+        with self._lock:
+            self._drop_expired()
+            if self._keys:
+                _, private_key, public_key = self._keys.popleft()
+                self.served += 1
+                self._lock.notify()
+                return private_key, public_key
+            self.empty_hits += 1
+            self.served += 1
+            self._lock.notify()
+
+        # Pool ran dry: pay for a key on the caller's thread
+        private_key, public_key = self.generate()
+        with self._lock:
+            self.generated += 1
+        return private_key, public_key
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': len(self._keys),
+                'size': self.size,
+                'generated': self.generated,
+                'served': self.served,
+                'empty_hits': self.empty_hits,
+                'empty_rate': self.empty_hits / self.served if self.served else 0.0,
+                'expired': self.expired,
+            }
+
+    def _drop_expired(self):
+        cutoff = time.monotonic() - self.key_lifetime
+        while self._keys and self._keys[0][0] < cutoff:
+            self._keys.popleft()
+            self.expired += 1
+
+    def _refill(self):
+        while True:
+            with self._lock:
+                self._drop_expired()
+                while len(self._keys) >= self.size:
+                    # Wake up when a key is taken or the oldest one is due to expire
+                    timeout = self._keys[0][0] + self.key_lifetime - time.monotonic()
+                    self._lock.wait(timeout=max(timeout, 0))
+                    self._drop_expired()
+
+            private_key, public_key = self.generate()
+            with self._lock:
+                self._keys.append((time.monotonic(), private_key, public_key))
+                self.generated += 1
@@ -0,0 +1,136 @@
+import numpy as np
+
+# LSB embedding shared by the server (VSserver.py) and the client (VSClient.py).
+#
+# Bits are laid out in the same order the original per-pixel loop used:
+# column-major over the image (x outer, y inner) and R, G, B inside each
+# pixel, most significant bit of every byte first. Frames coming from OpenCV
+# are BGR, so the channel index is mirrored when channel_order is 'bgr'.
+#
+# Each channel value is a "slot" holding bits_per_channel (1-4) low bits,
+# filled most significant first. With channels=4 the alpha channel of a
+# 4-channel frame is used as a fourth slot per pixel. At the default depth
+# of 1 bit over 3 channels, slot n is simply bit n of the payload.
+
+MAX_BITS_PER_CHANNEL = 4
+
+
+def capacity(width, height, bits_per_channel=1, channels=3):
+    return width * height * channels * bits_per_channel // 8
+
+
+def frame_capacity(frame, bits_per_channel=1, channels=3):
+    height, width = frame.shape[:2]
+    return capacity(width, height, bits_per_channel, channels)
+
+
+# Flags byte recorded in payload and shard headers to describe the depth of
+# the data after the header: bits 0-1 hold bits_per_channel - 1, bit 2 is
+# set when the alpha channel is used
+def depth_flags(bits_per_channel=1, channels=3):
+    if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL or channels not in (3, 4):
+        raise ValueError(f"Unsupported depth: {bits_per_channel} bits over {channels} channels")
+    return (bits_per_channel - 1) | (0x04 if channels == 4 else 0)
+
+
+def flags_depth(flags):
+    return (flags & 0x03) + 1, 4 if flags & 0x04 else 3
+
+
+# Headers are always written at 1 bit per RGB channel so they can be read
+# before the depth is known. Returns the first slot of the data after a
+# header of header_size bytes; with alpha the data starts on the next whole
+# pixel, since slots are numbered per 4 channels from there on.
+def data_start(header_size, channels=3):
+    header_slots = header_size * 8
+    if channels == 3:
+        return header_slots
+    return -(-header_slots // 3) * channels
+
+
+# Bytes available after a header of header_size bytes at the given depth
+def region_capacity(width, height, header_size, bits_per_channel=1, channels=3):
+    slots = width * height * channels - data_start(header_size, channels)
+    return max(0, slots * bits_per_channel // 8)
+
+
+# Work out (row, column, channel) for n slots of a frame, starting at slot `start`
+def bit_positions(shape, n_bits, channel_order='bgr', start=0, channels=3):
+    height = shape[0]
+    k = np.arange(start, start + n_bits, dtype=np.int64)
+    x = k // (channels * height)
+    y = (k // channels) % height
+    c = k % channels
+    if channel_order == 'bgr':
+        c = np.where(c < 3, 2 - c, c)
+    return y, x, c
+
+
+def _check_channels(frame, channels):
+    if channels == 4 and (frame.ndim < 3 or frame.shape[2] < 4):
+        raise ValueError("Frame has no alpha channel to embed into")
+
+
+# Embed raw bytes into the low bits of a frame (H x W x 3 or 4 uint8 array)
+def embed_data(frame, data, channel_order='bgr', in_place=False, bits_per_channel=1, channels=3, start_slot=0):
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    _check_channels(frame, channels)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+    n_slots = -(-len(bits) // bits_per_channel)
+    total_slots = frame.shape[0] * frame.shape[1] * channels
+    if start_slot + n_slots > total_slots:
+        available = (total_slots - start_slot) * bits_per_channel // 8
+        raise ValueError(f"Payload of {len(data)} bytes exceeds frame capacity of {available} bytes")
+
+    if bits_per_channel == 1:
+        values = bits
+    else:
+        bits = np.pad(bits, (0, n_slots * bits_per_channel - len(bits)))
+        weights = 1 << np.arange(bits_per_channel - 1, -1, -1, dtype=np.uint8)
+        values = (bits.reshape(n_slots, bits_per_channel) * weights).sum(axis=1, dtype=np.uint8)
+
+    encoded = frame if in_place else frame.copy()
+    y, x, c = bit_positions(frame.shape, n_slots, channel_order, start=start_slot, channels=channels)
+    keep = 0xFF ^ ((1 << bits_per_channel) - 1)
+    encoded[y, x, c] = (encoded[y, x, c] & keep) | values
+    return encoded
+
+
+# Read n_bytes of raw data from the low bits of a frame, starting at byte
+# `offset` of the data that begins at `start_slot`
+def extract_data(frame, n_bytes, channel_order='bgr', offset=0, bits_per_channel=1, channels=3, start_slot=0):
+    _check_channels(frame, channels)
+    bit_start = offset * 8
+    first_slot = start_slot + bit_start // bits_per_channel
+    skip = bit_start % bits_per_channel
+
+    total_slots = frame.shape[0] * frame.shape[1] * channels
+    available_bits = max(0, (total_slots - first_slot) * bits_per_channel - skip)
+    n_bits = min(n_bytes, available_bits // 8) * 8
+    n_slots = -(-(skip + n_bits) // bits_per_channel)
+
+    y, x, c = bit_positions(frame.shape, n_slots, channel_order, start=first_slot, channels=channels)
+    if bits_per_channel == 1:
+        bits = frame[y, x, c] & 1
+    else:
+        shifts = np.arange(bits_per_channel - 1, -1, -1, dtype=np.uint8)
+        bits = ((frame[y, x, c][:, None] >> shifts) & 1).reshape(-1)[skip:skip + n_bits]
+    return np.packbits(bits).tobytes()
+
+
+# Read bytes until the delimiter shows up, decoding in growing chunks so the
+# work is proportional to the payload rather than the frame size.
+# Returns None if the delimiter is never found.
+def extract_until(frame, delimiter=b"###", channel_order='bgr', chunk_size=256):
+    capacity = frame_capacity(frame)
+    data = b""
+    while len(data) < capacity:
+        search_from = max(0, len(data) - len(delimiter) + 1)
+        data += extract_data(frame, chunk_size, channel_order, offset=len(data))
+        delimiter_index = data.find(delimiter, search_from)
+        if delimiter_index != -1:
+            return data[:delimiter_index]
+        chunk_size *= 2
+    return None
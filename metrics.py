@@ -0,0 +1,195 @@
+import bisect
+import collections
+import contextlib
+import math
+import threading
+import time
+import uuid
+
+# Stage timings, counters and per-session traces for VSserver.py and
+# VSClient.py, rendered in the Prometheus text exposition format for their
+# /metrics endpoints. Each app owns one Metrics object; every metric name
+# starts with its prefix.
+#
+#   with trace.stage('handshake'):
+#       ...
+#
+# times the block into <prefix>_stage_seconds{stage="handshake"} and adds a
+# span to the trace, which is kept (most recent `keep_traces`) for /traces.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self._values[tuple(labels.get(name, '') for name in self.labelnames)] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {_format(total)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, tuple(labelnames), buckets
+        self._series = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ('le',)
+        for values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(names, values + (_format(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {_format(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {count}")
+        return lines
+
+
+# One session's (or one client operation's) stages, in order
+class Trace:
+    def __init__(self, metrics=None, trace_id=None, kind='session'):
+        self.id = trace_id or uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.started = time.time()
+        self.seconds = None
+        self.outcome = None
+        self.spans = []
+        self.attributes = {}
+        self._metrics = metrics
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.spans.append({'stage': name, 'offset': round(start - self._start, 6), 'seconds': round(seconds, 6),
+                               'error': error})
+            if self._metrics is not None:
+                self._metrics.observe_stage(name, seconds, failed=error is not None)
+
+    def finish(self, outcome='complete', error=None):
+        if self.outcome is not None:
+            return
+        self.seconds = time.perf_counter() - self._start
+        self.outcome = outcome
+        if error is not None:
+            self.attributes['error'] = error
+        if self._metrics is not None:
+            self._metrics.finish_trace(self)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'started': self.started,
+            'seconds': round(self.seconds, 6) if self.seconds is not None else None,
+            'outcome': self.outcome,
+            'attributes': dict(self.attributes),
+            'spans': list(self.spans),
+        }
+
+
+class Metrics:
+    def __init__(self, prefix, keep_traces=256):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stage_seconds = Histogram(f"{prefix}_stage_seconds", "Time spent in each pipeline stage", ('stage',))
+        self._stage_errors = Counter(f"{prefix}_stage_errors_total", "Stages that raised", ('stage',))
+        self._trace_seconds = Histogram(f"{prefix}_trace_seconds", "End-to-end time of sessions and operations",
+                                        ('kind', 'outcome'))
+        self._counters = {}
+        self._gauges = []  # (name, help, function)
+        self._traces = collections.OrderedDict()  # id -> Trace, oldest first
+        self._keep_traces = keep_traces
+
+    def trace(self, trace_id=None, kind='session'):
+        trace = Trace(self, trace_id, kind)
+        with self._lock:
+            self._traces[trace.id] = trace
+            while len(self._traces) > self._keep_traces:
+                self._traces.popitem(last=False)
+        return trace
+
+    def get_trace(self, trace_id):
+        with self._lock:
+            return self._traces.get(trace_id)
+
+    def traces(self):
+        with self._lock:
+            return [trace.to_dict() for trace in self._traces.values()]
+
+    def observe_stage(self, stage, seconds, failed=False):
+        with self._lock:
+            self._stage_seconds.observe(seconds, stage=stage)
+            if failed:
+                self._stage_errors.inc(stage=stage)
+
+    def finish_trace(self, trace):
+        with self._lock:
+            self._trace_seconds.observe(trace.seconds, kind=trace.kind, outcome=trace.outcome)
+
+    # Time every call of func as a stage outside any trace (e.g. background work)
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            with Trace(self).stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, help_text, amount=1, **labels):
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = Counter(f"{self.prefix}_{name}", help_text, sorted(labels))
+            counter.inc(amount, **labels)
+
+    # A value read when /metrics is scraped, e.g. a pool depth
+    def gauge(self, name, help_text, function):
+        self._gauges.append((f"{self.prefix}_{name}", help_text, function))
+
+    def render(self):
+        with self._lock:
+            lines = self._stage_seconds.render() + self._stage_errors.render() + self._trace_seconds.render()
+            for counter in self._counters.values():
+                lines += counter.render()
+        for name, help_text, function in self._gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_format(function())}"]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,65 @@
+import base64
+import binascii
+import struct
+import zlib
+
+from lsb import embed_data, extract_data, extract_until, depth_flags, flags_depth, data_start, region_capacity
+
+# Binary payload container embedded in a frame:
+#
+#   magic (4) | version (1) | flags (1) | length (4) | crc32 of data (4) | data
+#
+# The header is always at 1 bit per RGB channel; its flags byte records the
+# depth (bits per channel, alpha) the data after it was written at, see
+# lsb.depth_flags. Embedding and extraction touch exactly the header and
+# `length` bytes of data.
+# Frames written before this format carry base64 text terminated by "###";
+# read_payload still understands those and returns the decoded bytes, so
+# callers always get raw bytes back.
+
+PAYLOAD_MAGIC = b'VSPL'
+PAYLOAD_VERSION = 1
+PAYLOAD_HEADER = struct.Struct('!4sBBII')
+
+
+class PayloadError(Exception):
+    pass
+
+
+def payload_capacity(width, height, bits_per_channel=1, channels=3):
+    return region_capacity(width, height, PAYLOAD_HEADER.size, bits_per_channel, channels)
+
+
+def embed_payload(frame, data, bits_per_channel=1, channels=3, in_place=True):
+    height, width = frame.shape[:2]
+    if len(data) > payload_capacity(width, height, bits_per_channel, channels):
+        raise PayloadError(f"Payload of {len(data)} bytes exceeds frame capacity of "
+                           f"{payload_capacity(width, height, bits_per_channel, channels)} bytes")
+    flags = depth_flags(bits_per_channel, channels)
+    header = PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, PAYLOAD_VERSION, flags, len(data), zlib.crc32(data))
+    frame = embed_data(frame, header, in_place=in_place)
+    return embed_data(frame, data, in_place=True, bits_per_channel=bits_per_channel, channels=channels,
+                      start_slot=data_start(PAYLOAD_HEADER.size, channels))
+
+
+def read_payload(frame):
+    header = extract_data(frame, PAYLOAD_HEADER.size)
+    magic, version, flags, length, checksum = PAYLOAD_HEADER.unpack(header)
+    if magic == PAYLOAD_MAGIC and version == PAYLOAD_VERSION:
+        bits_per_channel, channels = flags_depth(flags)
+        height, width = frame.shape[:2]
+        usable = channels == 3 or (frame.ndim == 3 and frame.shape[2] >= 4)
+        if usable and length <= payload_capacity(width, height, bits_per_channel, channels):
+            data = extract_data(frame, length, bits_per_channel=bits_per_channel, channels=channels,
+                                start_slot=data_start(PAYLOAD_HEADER.size, channels))
+            if zlib.crc32(data) == checksum:
+                return data
+
+    # Legacy base64 text with a "###" delimiter
+    text = extract_until(frame, b"###")
+    if text is None:
+        raise PayloadError("Frame carries no payload")
+    try:
+        return base64.b64decode(text, validate=True)
+    except binascii.Error:
+        raise PayloadError("Frame carries neither a binary payload nor legacy base64 text")
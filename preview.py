@@ -0,0 +1,206 @@
+import collections
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Browser previews of received videos, built in the background and cached by
+# the content hash of the video, so decrypting returns as soon as the
+# message is out and asking again for the same video costs nothing.
+# `convert(source_path, output_path)` does the actual conversion.
+#
+# A preview can also be built while the video is still arriving: chunks are
+# fed to `stream_command(output_path)` (ffmpeg reading stdin) through a
+# bounded queue. If the transcoder falls behind by more than the queue it is
+# dropped, so it never throttles the transfer, and the preview is built from
+# the finished file instead.
+#
+# Finished previews are bounded to max_bytes in total; the least recently
+# requested are evicted first, always keeping the newest.
+
+
+class PreviewStream:
+    def __init__(self, command, output_path, queue_limit=64):
+        self.output_path = output_path
+        self.abandoned = False
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+        self._chunks = queue.Queue(maxsize=queue_limit)
+        self._writer = threading.Thread(target=self._feed, daemon=True)
+        self._writer.start()
+
+    def write(self, data):
+        if self.abandoned:
+            return
+        try:
+            self._chunks.put_nowait(bytes(data))
+        except queue.Full:
+            self.abandon()
+
+    def _feed(self):
+        try:
+            for chunk in iter(self._chunks.get, None):
+                self._process.stdin.write(chunk)
+            self._process.stdin.close()
+        except OSError:
+            self.abandoned = True
+
+    def abandon(self):
+        self.abandoned = True
+        self._process.kill()
+        try:
+            self._chunks.put_nowait(None)
+        except queue.Full:
+            pass  # The writer fails on the dead pipe instead
+
+    # Stop the transcoder and drop whatever it wrote
+    def discard(self):
+        self.abandon()
+        self.finish()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    # Wait for the transcoder to finish. Returns True if the output is complete.
+    def finish(self):
+        if not self.abandoned:
+            self._chunks.put(None)
+        self._writer.join()
+        return self._process.wait() == 0 and not self.abandoned
+
+
+class PreviewCache:
+    def __init__(self, directory, convert, stream_command=None, workers=2, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.convert = convert
+        self.stream_command = stream_command
+        self.max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        self._pending = {}  # digest -> Future, for previews being built
+        self._entries = collections.OrderedDict()  # digest -> size of finished previews, least recent first
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            digest, ext = os.path.splitext(name)
+            if ext == '.mp4':
+                path = os.path.join(directory, name)
+                found.append((os.path.getmtime(path), digest, os.path.getsize(path)))
+        for _, digest, size in sorted(found):
+            self._entries[digest] = size
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + '.mp4')
+
+    # Start building the preview for a video unless it exists or is underway
+    # (a failed or evicted one is rebuilt). The source is linked aside first,
+    # so a new video replacing it at video_path does not change what is
+    # converted.
+    def request(self, digest, video_path):
+        with self._lock:
+            future = self._pending.get(digest)
+            if self._touch(digest) or (future is not None and not future.done()):
+                return
+            source_path = os.path.join(self.directory, digest + '.src')
+            if not os.path.exists(source_path):
+                try:
+                    os.link(video_path, source_path)
+                except OSError:
+                    shutil.copyfile(video_path, source_path)
+            self._pending[digest] = self._pool.submit(self._build, digest, source_path)
+
+    def _build(self, digest, source_path):
+        temp_path = self.path(digest) + '.tmp'
+        try:
+            self.convert(source_path, temp_path)
+            os.replace(temp_path, self.path(digest))
+            self._add(digest)
+        finally:
+            for path in (temp_path, source_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Start a transcoder fed with the video as it arrives. Returns None when
+    # streaming is not configured or the transcoder cannot be started.
+    def open_stream(self):
+        if self.stream_command is None:
+            return None
+        output_path = os.path.join(self.directory, f"stream-{uuid.uuid4().hex[:12]}.mp4.tmp")
+        try:
+            return PreviewStream(self.stream_command(output_path), output_path)
+        except OSError as e:
+            print(f"Could not start streaming preview: {e}")
+            return None
+
+    # The video is complete and its hash known: wait for the streamed preview
+    # in the background and file it under the hash. If it did not complete,
+    # the next request() builds it from the file.
+    def finish_stream(self, stream, digest):
+        with self._lock:
+            self._pending[digest] = self._pool.submit(self._finish_stream, stream, digest)
+
+    def _finish_stream(self, stream, digest):
+        try:
+            if os.path.exists(self.path(digest)):
+                stream.abandon()
+            if not stream.finish():
+                raise RuntimeError("Streaming preview did not complete")
+            os.replace(stream.output_path, self.path(digest))
+            self._add(digest)
+        finally:
+            if os.path.exists(stream.output_path):
+                os.remove(stream.output_path)
+
+    # 'ready', 'pending', 'failed' (with the error) or 'missing' (never
+    # requested by this process, or evicted)
+    def status(self, digest):
+        with self._lock:
+            if self._touch(digest):
+                return 'ready', None
+            future = self._pending.get(digest)
+        if future is None:
+            return 'missing', None
+        if not future.done():
+            return 'pending', None
+        error = future.exception()
+        if error is not None:
+            return 'failed', str(error)
+        return 'missing', None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(self._entries.values()),
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+    # Mark a finished preview as recently used. False if there is none.
+    # Called with the lock held.
+    def _touch(self, digest):
+        if digest not in self._entries:
+            return False
+        self._entries.move_to_end(digest)
+        return True
+
+    def _add(self, digest):
+        size = os.path.getsize(self.path(digest))
+        with self._lock:
+            self._entries[digest] = size
+            self._entries.move_to_end(digest)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        for digest in list(self._entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(digest)
+            if os.path.exists(self.path(digest)):
+                os.remove(self.path(digest))
+            self.evictions += 1
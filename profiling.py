@@ -0,0 +1,127 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+# Opt-in profiling of a sampled fraction of sessions. For a sampled session
+# each profiled section (a block of work on one thread) is run under cProfile
+# and, if memory tracking is on, tracemalloc. Two files are written per
+# section:
+#
+#   <directory>/<session>-<section>.prof   pstats data (python -m pstats, snakeviz)
+#   <directory>/<session>-<section>.txt    top functions by cumulative time,
+#                                          peak traced memory and the largest live
+#                                          allocation sites when the section ended
+#
+# Configured from the environment by default:
+#
+#   VS_PROFILE_RATE     fraction of sessions to profile, 0 (off) to 1
+#   VS_PROFILE_DIR      output directory (default "profiles")
+#   VS_PROFILE_MEMORY   "0" to skip tracemalloc (default on)
+#
+# cProfile only sees the thread it runs on, so sections should wrap work done
+# on a single thread. Only one section in the process is profiled at a time
+# (Python 3.12+ refuses a second active profiler); a sampled section that
+# starts while another is running is not profiled. Profiling never fails the
+# work it wraps: errors starting it or writing the reports are printed.
+
+# Held by the section being profiled, across every profiler in the process
+_profiling_lock = threading.Lock()
+
+
+class SessionProfiler:
+    def __init__(self, rate=0.0, directory='profiles', memory=True, top=25, traceback_frames=10):
+        self.rate = rate
+        self.directory = directory
+        self.memory = memory
+        self.top = top
+        self.traceback_frames = traceback_frames
+
+    @classmethod
+    def from_env(cls, prefix='VS_PROFILE'):
+        return cls(rate=float(os.environ.get(f'{prefix}_RATE', '0') or 0),
+                   directory=os.environ.get(f'{prefix}_DIR', 'profiles'),
+                   memory=os.environ.get(f'{prefix}_MEMORY', '1') != '0')
+
+    # Decide once per session whether it is profiled
+    def sample(self):
+        return self.rate > 0 and random.random() < self.rate
+
+    @contextlib.contextmanager
+    def section(self, session_id, name, sampled=True):
+        if not sampled or not _profiling_lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            profile, tracing = self._start()
+        except Exception as e:
+            _profiling_lock.release()
+            print(f"Could not start profiling {session_id}-{name}: {e}")
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            try:
+                self._finish(f"{session_id}-{name}", profile, seconds, tracing)
+            except Exception as e:
+                print(f"Could not write the profile of {session_id}-{name}: {e}")
+            finally:
+                if tracing and tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                _profiling_lock.release()
+
+    # func wrapped in a section, for handing to an executor
+    def wrap(self, session_id, name, sampled, func):
+        def wrapper(*args, **kwargs):
+            with self.section(session_id, name, sampled):
+                return func(*args, **kwargs)
+        return wrapper
+
+    # Returns (profile, whether tracemalloc was started for the section)
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(self.traceback_frames)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception:
+            if tracing:
+                tracemalloc.stop()
+            raise
+        return profile, tracing
+
+    def _finish(self, base, profile, seconds, tracing):
+        profile.disable()
+        snapshot = peak = None
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self._write(base, profile, seconds, snapshot, peak)
+
+    def _write(self, base, profile, seconds, snapshot, peak):
+        path = os.path.join(self.directory, base)
+        profile.dump_stats(path + '.prof')
+
+        report = io.StringIO()
+        report.write(f"{base}: {seconds:.3f} s\n\n")
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(self.top)
+        if snapshot is not None:
+            report.write(f"Peak traced memory: {peak / 2 ** 20:.1f} MiB\n\n"
+                         "Largest allocation sites still live at the end:\n")
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                report.write(f"  {stat}\n")
+        with open(path + '.txt', 'w') as f:
+            f.write(report.getvalue())
@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import os
+import struct
+
+# Wire protocol between VSserver.py and VSClient.py.
+#
+# Every message is a fixed header (1-byte type, 8-byte big-endian payload
+# length) followed by the payload, so neither side ever has to guess where
+# one message ends and the next begins. Video bodies are streamed straight
+# from/to disk in chunks instead of being held in memory.
+#
+# The helpers are asyncio coroutines built on the loop's raw socket API, so
+# zero-copy sendfile and recv_into are used. Sockets must be non-blocking.
+
+MSG_DH_PUBLIC = 1
+MSG_PUBLIC_KEY = 2
+MSG_VIDEO = 3
+MSG_FRAME_INDEX = 4  # frame_index.py index of the video that follows, empty if there is none
+
+# Largest payload accepted per message type, checked before anything is
+# allocated for it. Videos are streamed to disk and not limited here.
+MAX_LENGTH = {
+    MSG_DH_PUBLIC: 64,
+    MSG_PUBLIC_KEY: 16 << 10,
+    MSG_VIDEO: None,
+    MSG_FRAME_INDEX: 64 << 20,
+}
+
+HEADER = struct.Struct('!BQ')
+CHUNK_SIZE = 1 << 20
+SENDFILE_SEGMENT = 8 << 20  # sendfile piece size when reporting transfer progress
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Open `path` for writing, or pass a writable file object through left open
+def _open_target(path):
+    if isinstance(path, (str, bytes, os.PathLike)):
+        return open(path, 'wb')
+    return contextlib.nullcontext(path)
+
+
+async def async_recv_exact(sock, n):
+    loop = asyncio.get_running_loop()
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = await loop.sock_recv_into(sock, view[received:])
+        if count == 0:
+            raise ProtocolError(f"Connection closed after {received} of {n} bytes")
+        received += count
+    return bytes(data)
+
+
+async def async_send_message(sock, msg_type, payload):
+    await asyncio.get_running_loop().sock_sendall(sock, HEADER.pack(msg_type, len(payload)) + payload)
+
+
+async def async_recv_header(sock, expected_type=None):
+    msg_type, length = HEADER.unpack(await async_recv_exact(sock, HEADER.size))
+    if expected_type is not None and msg_type != expected_type:
+        raise ProtocolError(f"Expected message type {expected_type}, got {msg_type}")
+    if msg_type not in MAX_LENGTH:
+        raise ProtocolError(f"Unknown message type {msg_type}")
+    if MAX_LENGTH[msg_type] is not None and length > MAX_LENGTH[msg_type]:
+        raise ProtocolError(f"Message type {msg_type} of {length} bytes exceeds its limit of "
+                            f"{MAX_LENGTH[msg_type]} bytes")
+    return msg_type, length
+
+
+async def async_recv_message(sock, expected_type=None):
+    msg_type, length = await async_recv_header(sock, expected_type)
+    return msg_type, await async_recv_exact(sock, length)
+
+
+# With a progress callback the file goes out in SENDFILE_SEGMENT pieces and
+# progress(fraction) is called after each one
+async def async_send_file(sock, msg_type, path, progress=None):
+    loop = asyncio.get_running_loop()
+    size = os.path.getsize(path)
+    await loop.sock_sendall(sock, HEADER.pack(msg_type, size))
+    with open(path, 'rb') as f:
+        if progress is None:
+            sent = await loop.sock_sendfile(sock, f)
+        else:
+            sent = 0
+            while sent < size:
+                count = await loop.sock_sendfile(sock, f, sent, min(SENDFILE_SEGMENT, size - sent))
+                if count == 0:
+                    break
+                sent += count
+                progress(sent / size)
+    if sent != size:
+        raise ProtocolError(f"Sent {sent} of {size} bytes of {path}")
+    return size
+
+
+# Receive a file message into `path` (a path or a writable file object),
+# reading through one reusable buffer. `digest`, a hashlib object, is updated
+# with the body as it arrives, and every chunk is also written to each file
+# object in `tee`.
+async def async_recv_file(sock, path, expected_type=None, buffer=None, digest=None, tee=()):
+    loop = asyncio.get_running_loop()
+    _, remaining = await async_recv_header(sock, expected_type)
+    buffer = buffer if buffer is not None else bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    size = remaining
+    with _open_target(path) as f:
+        while remaining:
+            count = await loop.sock_recv_into(sock, view[:min(len(view), remaining)])
+            if count == 0:
+                raise ProtocolError(f"Connection closed with {remaining} bytes of video outstanding")
+            f.write(view[:count])
+            if digest is not None:
+                digest.update(view[:count])
+            for sink in tee:
+                sink.write(view[:count])
+            remaining -= count
+    return size
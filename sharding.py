@@ -0,0 +1,118 @@
+import struct
+import zlib
+
+from frame_store import FrameStore
+from lsb import embed_data, extract_data, depth_flags, flags_depth, data_start, region_capacity
+
+# Spread a payload that does not fit in one frame across several frames.
+# Each shard carries a small header so the receiver can find the rest:
+#
+#   magic (4) | index (2) | count (2) | length (4) | crc32 of chunk (4) | flags (1)
+#
+# As with payload.py, the header is at 1 bit per RGB channel and the flags
+# byte records the depth the chunk after it was written at.
+#
+# Shard i of a payload starting at frame `start` lives in the i-th frame of
+# shard_frames(start, count, frame_count, reserved). Embedding and
+# extraction of the individual shards are independent, so both run on a
+# process pool when one is given.
+
+SHARD_MAGIC = b'VSSH'
+SHARD_HEADER = struct.Struct('!4sHHIIB')
+
+
+class ShardError(Exception):
+    pass
+
+
+def shard_capacity(width, height, bits_per_channel=1, channels=3):
+    return region_capacity(width, height, SHARD_HEADER.size, bits_per_channel, channels)
+
+
+def split_payload(data, chunk_size):
+    if chunk_size <= 0:
+        raise ShardError("Frame is too small to hold a shard header")
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [b'']
+    if len(chunks) > 0xFFFF:
+        raise ShardError(f"Payload of {len(data)} bytes needs more than 65535 shards")
+    return chunks
+
+
+# Frame numbers for `count` shards: consecutive frames from `start`, wrapping
+# at the end of the video and skipping frames that already carry other data
+def shard_frames(start, count, frame_count, reserved=()):
+    reserved = set(reserved) - {start}
+    if count > frame_count - len(reserved & set(range(frame_count))):
+        raise ShardError(f"{count} shards do not fit in a {frame_count}-frame video")
+    frames = []
+    frame_number = start
+    while len(frames) < count:
+        if frame_number not in reserved:
+            frames.append(frame_number)
+        frame_number = (frame_number + 1) % frame_count
+    return frames
+
+
+def embed_shard(frame, index, count, chunk, bits_per_channel=1, channels=3):
+    flags = depth_flags(bits_per_channel, channels)
+    header = SHARD_HEADER.pack(SHARD_MAGIC, index, count, len(chunk), zlib.crc32(chunk), flags)
+    frame = embed_data(frame, header)
+    return embed_data(frame, chunk, in_place=True, bits_per_channel=bits_per_channel, channels=channels,
+                      start_slot=data_start(SHARD_HEADER.size, channels))
+
+
+def is_shard(frame):
+    return extract_data(frame, len(SHARD_MAGIC)) == SHARD_MAGIC
+
+
+def read_shard_header(frame):
+    magic, index, count, length, checksum, flags = SHARD_HEADER.unpack(extract_data(frame, SHARD_HEADER.size))
+    if magic != SHARD_MAGIC:
+        raise ShardError("Frame does not carry a shard")
+    return index, count, length, checksum, flags
+
+
+def read_shard(frame):
+    index, count, length, checksum, flags = read_shard_header(frame)
+    bits_per_channel, channels = flags_depth(flags)
+    chunk = extract_data(frame, length, bits_per_channel=bits_per_channel, channels=channels,
+                         start_slot=data_start(SHARD_HEADER.size, channels))
+    if len(chunk) != length or zlib.crc32(chunk) != checksum:
+        raise ShardError(f"Shard {index} failed its checksum")
+    return index, count, chunk
+
+
+# Embed one chunk per frame, one task per frame on the pool if given
+def embed_shards(frames, chunks, bits_per_channel=1, channels=3, pool=None):
+    count = len(chunks)
+    args = (frames, range(count), [count] * count, chunks, [bits_per_channel] * count, [channels] * count)
+    if pool is None:
+        return list(map(embed_shard, *args))
+    return list(pool.map(embed_shard, *args))
+
+
+# As embed_shards, with each frame read by its worker from the frame store
+# at `store_path` rather than pickled over to it
+def embed_store_shards(store_path, frame_numbers, chunks, bits_per_channel=1, channels=3, pool=None):
+    count = len(chunks)
+    args = ([store_path] * count, frame_numbers, range(count), [count] * count, chunks, [bits_per_channel] * count,
+            [channels] * count)
+    if pool is None:
+        return list(map(_embed_store_shard, *args))
+    return list(pool.map(_embed_store_shard, *args))
+
+
+# Opened per task rather than kept open in the worker, so the mapping of a
+# store that is removed afterwards does not pin its disk space
+def _embed_store_shard(store_path, frame_number, index, count, chunk, bits_per_channel, channels):
+    return embed_shard(FrameStore(store_path)[frame_number], index, count, chunk, bits_per_channel, channels)
+
+
+# Read every shard back and reassemble the payload
+def gather_shards(frames, pool=None):
+    results = list(pool.map(read_shard, frames)) if pool is not None else [read_shard(frame) for frame in frames]
+    count = results[0][1]
+    chunks = {index: chunk for index, _, chunk in results}
+    if len(results) != count or set(chunks) != set(range(count)):
+        raise ShardError(f"Expected {count} shards, got indices {sorted(chunks)}")
+    return b''.join(chunks[index] for index in range(count))
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def frame():
+    return np.random.default_rng(0).integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+
+@pytest.fixture
+def alpha_frame():
+    return np.random.default_rng(1).integers(0, 256, (48, 64, 4), dtype=np.uint8)
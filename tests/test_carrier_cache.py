@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from carrier_cache import CarrierCache, hash_file
+
+
+@pytest.fixture
+def sources(tmp_path):
+    paths = []
+    for n in range(4):
+        path = tmp_path / f'source{n}.avi'
+        path.write_bytes(bytes([n]) * 100)
+        paths.append(str(path))
+    return paths
+
+
+def put(cache, digest, source_path):
+    video_path = cache.put(digest, source_path, {'frame_count': 1, 'resolution': [1, 1]})
+    cache.release(digest)
+    return video_path
+
+
+def test_hash_file(sources):
+    assert hash_file(sources[0], chunk_size=7) == hash_file(sources[0])
+    assert hash_file(sources[0]) != hash_file(sources[1])
+
+
+def test_hit_returns_the_stored_carrier(tmp_path, sources):
+    cache = CarrierCache(str(tmp_path / 'cache'), max_bytes=1000)
+    assert cache.acquire('a') is None
+    put(cache, 'a', sources[0])
+    video_path, metadata = cache.acquire('a')
+    assert open(video_path, 'rb').read() == bytes([0]) * 100
+    assert metadata == {'frame_count': 1, 'resolution': [1, 1]}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 1, 100)
+
+
+def test_least_recently_used_is_evicted_first(tmp_path, sources):
+    cache = CarrierCache(str(tmp_path / 'cache'), max_bytes=250)
+    put(cache, 'a', sources[0])
+    put(cache, 'b', sources[1])
+    cache.acquire('a')
+    cache.release('a')
+    put(cache, 'c', sources[2])
+    assert cache.acquire('b') is None
+    assert cache.acquire('a') is not None and cache.acquire('c') is not None
+    assert cache.stats()['evictions'] == 1
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['a.avi', 'a.json', 'c.avi', 'c.json']
+
+
+def test_pinned_entries_are_not_evicted(tmp_path, sources):
+    cache = CarrierCache(str(tmp_path / 'cache'), max_bytes=150)
+    cache.put('a', sources[0], {})
+    put(cache, 'b', sources[1])
+    assert cache.acquire('a') is not None
+    assert cache.acquire('b') is None
+
+    cache.release('a')  # one pin left, from put
+    cache.release('a')
+    put(cache, 'c', sources[2])
+    assert cache.acquire('a') is None
+
+
+def test_sidecar_files_are_counted_and_evicted_together(tmp_path, sources):
+    cache = CarrierCache(str(tmp_path / 'cache'), max_bytes=250)
+    put(cache, 'a', sources[0])
+    with open(cache.sidecar_path('a', '.frames'), 'wb') as f:
+        f.write(bytes(100))
+    cache.refresh('a')
+    assert cache.stats()['bytes'] >= 200
+    put(cache, 'b', sources[1])
+    assert cache.acquire('a') is None
+    assert not os.path.exists(cache.sidecar_path('a', '.frames'))
+
+
+def test_restart_rescans_the_directory(tmp_path, sources):
+    directory = str(tmp_path / 'cache')
+    cache = CarrierCache(directory, max_bytes=250)
+    put(cache, 'a', sources[0])
+    put(cache, 'b', sources[1])
+    os.utime(cache.video_path('a'), (1, 1))  # a is the older entry after a restart
+    open(os.path.join(directory, 'c.avi'), 'wb').close()  # no metadata: not an entry
+
+    restarted = CarrierCache(directory, max_bytes=250)
+    assert restarted.stats()['entries'] == 2
+    put(restarted, 'd', sources[3])
+    assert restarted.acquire('a') is None
+    assert restarted.acquire('b') is not None
+    assert restarted.acquire('c') is None
+
+
+def test_move_takes_over_the_source(tmp_path, sources):
+    cache = CarrierCache(str(tmp_path / 'cache'), max_bytes=1000)
+    cache.put('a', sources[0], {}, move=True)
+    assert not os.path.exists(sources[0])
+    put(cache, 'b', sources[1])
+    assert os.path.exists(sources[1])
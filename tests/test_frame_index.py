@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('av')
+
+from frame_index import FrameIndex, FrameIndexError, build_frame_index, index_path, load_frame_index
+from video_io import read_frames_at, write_video_intra
+
+FRAME_COUNT = 12
+
+
+@pytest.fixture
+def video(tmp_path):
+    rng = np.random.default_rng(5)
+    frames = [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(FRAME_COUNT)]
+    path = str(tmp_path / 'intra.avi')
+    write_video_intra(iter(frames), path, 25, (64, 48))
+    return path
+
+
+def test_index_describes_the_video(video):
+    index = FrameIndex(build_frame_index(video))
+    assert (index.codec, index.width, index.height, index.frame_count) == ('ffv1', 64, 48, FRAME_COUNT)
+    assert index.matches(video)
+
+
+def test_indexed_reads_match_read_frames_at(video):
+    index = FrameIndex(build_frame_index(video))
+    wanted = [0, 5, FRAME_COUNT - 1, 3]
+    indexed = index.read_frames(video, wanted)
+    expected = read_frames_at(video, wanted)
+    assert sorted(indexed) == sorted(expected) == sorted(wanted)
+    for frame_number in wanted:
+        assert np.array_equal(indexed[frame_number], expected[frame_number])
+
+
+def test_out_of_range_frames_are_skipped(video):
+    index = FrameIndex(build_frame_index(video))
+    assert sorted(index.read_frames(video, [1, FRAME_COUNT, -1])) == [1]
+
+
+def test_sidecar_is_used_only_when_it_matches(video):
+    assert load_frame_index(video) is None
+    with open(index_path(video), 'wb') as f:
+        f.write(build_frame_index(video))
+    assert load_frame_index(video).frame_count == FRAME_COUNT
+
+    with open(video, 'ab') as f:
+        f.write(b'\0')
+    assert load_frame_index(video) is None
+
+
+def test_truncated_or_foreign_index(video):
+    data = build_frame_index(video)
+    with pytest.raises(FrameIndexError):
+        FrameIndex(data[:-1])
+    with pytest.raises(FrameIndexError):
+        FrameIndex(b'XXXX' + data[4:])
+    with pytest.raises(FrameIndexError):
+        FrameIndex(b'')
@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import time
+
+import pytest
+
+from ingest import IngestError, IngestFile
+
+BODY = bytes(range(256)) * 40
+
+
+# Write `body` into `ingest` in pieces from another thread, then run `end`
+def feed(ingest, body, end, pieces=8, delay=0.01):
+    def writer():
+        step = -(-len(body) // pieces)
+        for start in range(0, len(body), step):
+            ingest.write(body[start:start + step])
+            time.sleep(delay)
+        end()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    return thread
+
+
+def read_all(ingest, size=1000):
+    data = b''
+    with ingest.open_reader() as reader:
+        while chunk := reader.read(size):
+            data += chunk
+    return data
+
+
+@pytest.fixture
+def ingest(tmp_path):
+    return IngestFile(str(tmp_path / 'upload.avi'), idle_timeout=5)
+
+
+def test_reader_follows_the_upload_to_eof(ingest):
+    thread = feed(ingest, BODY, ingest.finish)
+    assert read_all(ingest) == BODY
+    thread.join()
+    assert ingest.size == len(BODY)
+    assert ingest.digest == hashlib.sha256(BODY).hexdigest()
+    assert open(ingest.path, 'rb').read() == BODY
+
+
+def test_read_everything_waits_for_the_end(ingest):
+    thread = feed(ingest, BODY, ingest.finish)
+    with ingest.open_reader() as reader:
+        assert reader.read() == BODY
+        assert reader.read(10) == b''
+    thread.join()
+
+
+def test_digest_needs_a_complete_upload(ingest):
+    ingest.write(b'partial')
+    with pytest.raises(IngestError):
+        ingest.digest
+
+
+def test_interrupted_upload_fails_readers(ingest):
+    thread = feed(ingest, BODY[:1000], ingest.close, pieces=2)
+    with pytest.raises(IngestError):
+        read_all(ingest)
+    thread.join()
+    assert ingest.failed and ingest.cancelled
+    with pytest.raises(IngestError):
+        ingest.digest
+
+
+def test_close_after_finish_keeps_the_upload(ingest):
+    ingest.write(BODY)
+    ingest.finish()
+    ingest.close()
+    assert not ingest.failed and not ingest.cancelled
+    assert read_all(ingest) == BODY
+
+
+def test_cancel_stops_a_waiting_reader_at_once(ingest):
+    ingest.write(b'x' * 10)
+    reader = ingest.open_reader()
+    assert reader.read(10) == b'x' * 10
+    threading.Timer(0.05, ingest.cancel).start()
+    start = time.perf_counter()
+    with pytest.raises(IngestError):
+        reader.read(10)
+    assert time.perf_counter() - start < 2
+    reader.close()
+
+
+def test_idle_upload_times_out(tmp_path):
+    ingest = IngestFile(str(tmp_path / 'upload.avi'), idle_timeout=0.05)
+    with pytest.raises(IngestError):
+        read_all(ingest)
+
+
+def test_decode_progress_reaches_a_late_watcher(ingest):
+    ingest.report_decoded(0.25)
+    seen = []
+    ingest.on_decoded = seen.append
+    ingest.report_decoded(0.5)
+    assert ingest.decoded == 0.5
+    assert seen == [0.5]
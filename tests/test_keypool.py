@@ -0,0 +1,56 @@
+import itertools
+import threading
+import time
+
+from keypool import KeyPool
+
+
+def counting_generator():
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def generate():
+        with lock:
+            n = next(counter)
+        return f"private{n}", f"public{n}"
+    return generate
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.005)
+
+
+def test_empty_pool_generates_inline():
+    pool = KeyPool(counting_generator(), size=0)
+    pool.start()
+    assert pool.get() == ("private0", "public0")
+    assert pool.get() == ("private1", "public1")
+    stats = pool.stats()
+    assert (stats['depth'], stats['generated'], stats['served'], stats['empty_hits']) == (0, 2, 2, 2)
+    assert stats['empty_rate'] == 1.0
+
+
+def test_refills_to_size_and_hands_out_each_key_once():
+    pool = KeyPool(counting_generator(), size=3)
+    pool.start()
+    wait_until(lambda: pool.stats()['depth'] == 3)
+    keys = [pool.get() for _ in range(6)]
+    assert len(set(keys)) == 6
+    wait_until(lambda: pool.stats()['depth'] == 3)
+    stats = pool.stats()
+    assert stats['served'] == 6
+    assert stats['generated'] == stats['served'] + stats['depth']
+
+
+def test_expired_keys_are_rotated_out():
+    pool = KeyPool(counting_generator(), size=2, key_lifetime=0.05)
+    pool.start()
+    wait_until(lambda: pool.stats()['depth'] == 2)
+    first = pool.get()
+    wait_until(lambda: pool.stats()['expired'] >= 2)
+    # The key still in the pool from before has been replaced by a newer one
+    assert int(pool.get()[0][len("private"):]) > int(first[0][len("private"):]) + 1
+    assert pool.stats()['expired'] >= 2
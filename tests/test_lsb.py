@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from lsb import embed_data, extract_data, extract_until
+
+
+# The original per-pixel embedder, on an RGB array instead of a PIL image:
+# column-major (x outer, y inner), R, G, B in each pixel, one bit per channel
+def legacy_embed(frame, data):
+    encoded = frame.copy()
+    height, width = frame.shape[:2]
+    data_bits = "".join(format(ord(char), '08b') for char in data)
+    bit_index = 0
+    for x in range(width):
+        for y in range(height):
+            for i in range(3):
+                if bit_index < len(data_bits):
+                    encoded[y, x, i] = int(encoded[y, x, i]) & ~1 | int(data_bits[bit_index])
+                    bit_index += 1
+            if bit_index >= len(data_bits):
+                return encoded
+    return encoded
+
+
+@pytest.mark.parametrize('data', ["", "a", "hello world###", "x" * 200])
+def test_matches_legacy_bit_order(frame, data):
+    assert np.array_equal(embed_data(frame, data, channel_order='rgb'), legacy_embed(frame, data))
+
+
+def test_bgr_mirrors_the_channels(frame):
+    data = "mirrored###"
+    rgb = embed_data(frame[..., ::-1].copy(), data, channel_order='rgb')
+    bgr = embed_data(frame, data, channel_order='bgr')
+    assert np.array_equal(bgr, rgb[..., ::-1])
+
+
+def test_extract_until_reads_legacy_frames(frame):
+    encoded = legacy_embed(frame[..., ::-1].copy(), "bGVnYWN5###")[..., ::-1]
+    assert extract_until(np.ascontiguousarray(encoded)) == b"bGVnYWN5"
+
+
+def test_extract_until_without_delimiter(frame):
+    assert extract_until(np.zeros_like(frame)) is None
+
+
+def test_extract_at_offset(frame):
+    encoded = embed_data(frame, b"0123456789")
+    assert extract_data(encoded, 4, offset=3) == b"3456"
+
+
+def test_payload_larger_than_the_frame(frame):
+    with pytest.raises(ValueError):
+        embed_data(frame, bytes(64 * 48 * 3 // 8 + 1))
@@ -0,0 +1,59 @@
+import base64
+
+import numpy as np
+import pytest
+
+from lsb import embed_data
+from payload import PAYLOAD_HEADER, PayloadError, embed_payload, payload_capacity, read_payload
+
+
+@pytest.mark.parametrize('bits_per_channel', [1, 2, 3, 4])
+def test_round_trip_at_each_depth(frame, bits_per_channel):
+    data = bytes(range(256)) * 3
+    embedded = embed_payload(frame.copy(), data, bits_per_channel=bits_per_channel)
+    assert read_payload(embedded) == data
+
+
+@pytest.mark.parametrize('bits_per_channel', [1, 2, 3, 4])
+def test_round_trip_with_alpha(alpha_frame, bits_per_channel):
+    data = b'alpha' * 100
+    embedded = embed_payload(alpha_frame.copy(), data, bits_per_channel=bits_per_channel, channels=4)
+    assert read_payload(embedded) == data
+
+
+def test_fills_the_frame_exactly(frame):
+    data = bytes(payload_capacity(64, 48, 2))
+    assert read_payload(embed_payload(frame.copy(), data, bits_per_channel=2)) == data
+    with pytest.raises(PayloadError):
+        embed_payload(frame.copy(), data + b'x', bits_per_channel=2)
+
+
+def test_only_touches_low_bits(frame):
+    embedded = embed_payload(frame.copy(), b'low bits only', bits_per_channel=3)
+    assert np.array_equal(embedded >> 3, frame >> 3)
+
+
+def test_not_in_place(frame):
+    original = frame.copy()
+    embed_payload(frame, b'copy', in_place=False)
+    assert np.array_equal(frame, original)
+
+
+def test_legacy_base64_with_delimiter(frame):
+    embedded = embed_data(frame.copy(), base64.b64encode(b'legacy secret').decode() + '###')
+    assert read_payload(embedded) == b'legacy secret'
+
+
+def test_checksum_mismatch_is_not_accepted(frame):
+    embedded = embed_payload(frame.copy(), b'checked data')
+    # Flip the low bit of the first data slot, right after the header
+    slot = PAYLOAD_HEADER.size * 8
+    y, x = slot // 3 % 48, slot // (3 * 48)
+    embedded[y, x, 2 - slot % 3] ^= 1
+    with pytest.raises(PayloadError):
+        read_payload(embedded)
+
+
+def test_frame_without_payload(frame):
+    with pytest.raises(PayloadError):
+        read_payload(frame & 0xFE)
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import io
+import socket
+
+import pytest
+
+from protocol import (HEADER, MAX_LENGTH, MSG_DH_PUBLIC, MSG_FRAME_INDEX, MSG_PUBLIC_KEY, MSG_VIDEO, ProtocolError,
+                      async_recv_file, async_recv_message, async_send_file, async_send_message)
+
+
+# Run coroutine_function(sender, receiver) over a connected pair of non-blocking sockets
+def over_socketpair(coroutine_function):
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    try:
+        return asyncio.run(coroutine_function(sender, receiver))
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_messages_keep_their_boundaries():
+    async def exchange(sender, receiver):
+        await async_send_message(sender, MSG_DH_PUBLIC, b"17")
+        await async_send_message(sender, MSG_PUBLIC_KEY, b"key")
+        await async_send_message(sender, MSG_FRAME_INDEX, b"")
+        return [await async_recv_message(receiver) for _ in range(3)]
+
+    assert over_socketpair(exchange) == [(MSG_DH_PUBLIC, b"17"), (MSG_PUBLIC_KEY, b"key"), (MSG_FRAME_INDEX, b"")]
+
+
+def test_file_round_trip(tmp_path):
+    body = bytes(range(256)) * 5000
+    source = tmp_path / 'source.avi'
+    source.write_bytes(body)
+    progress = []
+
+    async def exchange(sender, receiver):
+        digest, tee = hashlib.sha256(), io.BytesIO()
+        sending = asyncio.ensure_future(async_send_file(sender, MSG_VIDEO, str(source), progress=progress.append))
+        size = await async_recv_file(receiver, str(tmp_path / 'received.avi'), MSG_VIDEO, bytearray(4096), digest,
+                                     tee=[tee])
+        return await sending, size, digest.hexdigest(), tee.getvalue()
+
+    sent, size, digest, teed = over_socketpair(exchange)
+    assert sent == size == len(body)
+    assert (tmp_path / 'received.avi').read_bytes() == body == teed
+    assert digest == hashlib.sha256(body).hexdigest()
+    assert progress[-1] == 1.0
+
+
+def test_unexpected_type():
+    async def exchange(sender, receiver):
+        await async_send_message(sender, MSG_PUBLIC_KEY, b"key")
+        await async_recv_message(receiver, MSG_DH_PUBLIC)
+
+    with pytest.raises(ProtocolError):
+        over_socketpair(exchange)
+
+
+def test_unknown_type():
+    async def exchange(sender, receiver):
+        await async_send_message(sender, 99, b"")
+        await async_recv_message(receiver)
+
+    with pytest.raises(ProtocolError):
+        over_socketpair(exchange)
+
+
+@pytest.mark.parametrize('msg_type', [MSG_DH_PUBLIC, MSG_PUBLIC_KEY, MSG_FRAME_INDEX])
+def test_oversize_message_is_refused_from_its_header(msg_type):
+    # Only the header is sent, so a receiver that tried to read the body would hang
+    async def exchange(sender, receiver):
+        await asyncio.get_running_loop().sock_sendall(sender, HEADER.pack(msg_type, MAX_LENGTH[msg_type] + 1))
+        await asyncio.wait_for(async_recv_message(receiver), 5)
+
+    with pytest.raises(ProtocolError):
+        over_socketpair(exchange)
+
+
+def test_connection_closed_mid_message():
+    async def exchange(sender, receiver):
+        await asyncio.get_running_loop().sock_sendall(sender, HEADER.pack(MSG_PUBLIC_KEY, 10) + b"abc")
+        sender.close()
+        await async_recv_message(receiver)
+
+    with pytest.raises(ProtocolError):
+        over_socketpair(exchange)
@@ -0,0 +1,72 @@
+import random
+
+import numpy as np
+import pytest
+
+from sharding import (ShardError, embed_shards, gather_shards, is_shard, read_shard_header, shard_capacity,
+                      shard_frames, split_payload)
+
+
+def make_frames(count):
+    rng = np.random.default_rng(2)
+    return [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def test_split_payload():
+    assert split_payload(b'abcdefg', 3) == [b'abc', b'def', b'g']
+    assert split_payload(b'', 3) == [b'']
+    with pytest.raises(ShardError):
+        split_payload(b'abc', 0)
+
+
+def test_shard_frames_wrap_around_and_skip_reserved():
+    assert shard_frames(8, 5, 10, reserved={0, 9}) == [8, 1, 2, 3, 4]
+    assert shard_frames(3, 2, 10, reserved={3}) == [3, 4]
+    with pytest.raises(ShardError):
+        shard_frames(0, 9, 10, reserved={0, 5, 6})
+
+
+@pytest.mark.parametrize('bits_per_channel', [1, 2, 4])
+def test_reassembly_in_any_order(bits_per_channel):
+    data = bytes(random.Random(3).getrandbits(8) for _ in range(10000))
+    chunks = split_payload(data, shard_capacity(64, 48, bits_per_channel))
+    frames = embed_shards(make_frames(len(chunks)), chunks, bits_per_channel=bits_per_channel)
+    assert all(is_shard(frame) for frame in frames)
+    assert read_shard_header(frames[-1])[:2] == (len(chunks) - 1, len(chunks))
+
+    random.Random(4).shuffle(frames)
+    assert gather_shards(frames) == data
+
+
+def test_reassembly_of_a_wrapped_sequence():
+    frame_count = 10
+    data = bytes(range(256)) * 20
+    chunks = split_payload(data, shard_capacity(64, 48))
+    video = make_frames(frame_count)
+    frame_numbers = shard_frames(frame_count - 2, len(chunks), frame_count, reserved={0, 3})
+    assert frame_numbers[:3] == [8, 9, 1]
+    for frame_number, embedded in zip(frame_numbers, embed_shards([video[n] for n in frame_numbers], chunks)):
+        video[frame_number] = embedded
+    assert gather_shards([video[n] for n in frame_numbers]) == data
+
+
+def test_missing_shard():
+    chunks = split_payload(bytes(2000), shard_capacity(64, 48))
+    frames = embed_shards(make_frames(len(chunks)), chunks)
+    with pytest.raises(ShardError):
+        gather_shards(frames[:-1])
+
+
+def test_corrupt_shard():
+    chunks = split_payload(bytes(2000), shard_capacity(64, 48))
+    frames = embed_shards(make_frames(len(chunks)), chunks)
+    frames[1][:, 1] ^= 1  # The header fits in the first column, the chunk follows
+    with pytest.raises(ShardError):
+        gather_shards(frames)
+
+
+def test_not_a_shard():
+    frame = make_frames(1)[0] & 0xFE
+    assert not is_shard(frame)
+    with pytest.raises(ShardError):
+        read_shard_header(frame)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+av = pytest.importorskip('av')
+
+from lsb import embed_data
+from video_io import embed_video, read_frames, splice_video, write_video_intra
+
+FRAME_COUNT = 10
+TARGETS = (2, 7)
+
+
+@pytest.fixture
+def carrier(tmp_path):
+    rng = np.random.default_rng(7)
+    frames = [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(FRAME_COUNT)]
+    path = str(tmp_path / 'carrier.avi')
+    write_video_intra(iter(frames), path, 25, (64, 48))
+    return path
+
+
+def packets(video_path):
+    with av.open(video_path) as container:
+        return [bytes(packet) for packet in container.demux(container.streams.video[0]) if packet.dts is not None]
+
+
+def payloads():
+    return [(frame_number, f"payload {frame_number}".encode()) for frame_number in TARGETS]
+
+
+def test_splice_matches_a_full_re_encode(carrier, tmp_path):
+    spliced, encoded = str(tmp_path / 'spliced.avi'), str(tmp_path / 'encoded.avi')
+    assert embed_video(carrier, spliced, payloads(), splice=True) == FRAME_COUNT
+    assert embed_video(carrier, encoded, payloads(), splice=False) == FRAME_COUNT
+
+    original = list(read_frames(carrier))
+    spliced_frames, encoded_frames = list(read_frames(spliced)), list(read_frames(encoded))
+    assert len(spliced_frames) == len(encoded_frames) == FRAME_COUNT
+    for frame_number in range(FRAME_COUNT):
+        assert np.array_equal(spliced_frames[frame_number], encoded_frames[frame_number])
+        changed = not np.array_equal(spliced_frames[frame_number], original[frame_number])
+        assert changed == (frame_number in TARGETS)
+
+    for frame_number, data in payloads():
+        expected = embed_data(original[frame_number], data)
+        assert np.array_equal(spliced_frames[frame_number], expected)
+
+
+def test_untouched_packets_are_copied(carrier, tmp_path):
+    spliced = str(tmp_path / 'spliced.avi')
+    assert splice_video(carrier, spliced, payloads()) == FRAME_COUNT
+    for frame_number, (before, after) in enumerate(zip(packets(carrier), packets(spliced))):
+        assert (before == after) == (frame_number not in TARGETS)
+
+
+def test_replacements_are_spliced_in(carrier, tmp_path):
+    replacement = np.full((48, 64, 3), 9, dtype=np.uint8)
+    spliced = str(tmp_path / 'spliced.avi')
+    embed_video(carrier, spliced, [], splice=True, replacements={4: replacement})
+    assert np.array_equal(list(read_frames(spliced))[4], replacement)
+
+
+def test_inter_coded_source_is_not_spliced(tmp_path):
+    path = str(tmp_path / 'inter.avi')
+    with av.open(path, 'w') as container:
+        stream = container.add_stream('mpeg4', rate=25)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, 'yuv420p'
+        for _ in range(FRAME_COUNT):
+            frame = np.zeros((48, 64, 3), dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format='bgr24')):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    assert splice_video(path, str(tmp_path / 'spliced.avi'), payloads()) is None
+
+
+def test_target_past_the_end(carrier, tmp_path):
+    with pytest.raises(ValueError):
+        embed_video(carrier, str(tmp_path / 'spliced.avi'), [(FRAME_COUNT, b"late")], splice=True)
@@ -0,0 +1,416 @@
+import queue
+import threading
+from fractions import Fraction
+
+import cv2
+
+from lsb import embed_data
+
+try:
+    import av
+except ImportError:  # PyAV is optional, only splice mode and intra-only output need it
+    av = None
+
+# Streaming frame pipeline: frames are decoded, optionally embedded and
+# re-encoded one at a time, so memory stays flat regardless of video length
+# and untouched frames never hit the disk as PNGs.
+
+_END_OF_STREAM = object()
+
+# RGB FFV1 layouts whose decoded BGR frames round-trip losslessly
+SPLICE_PIX_FMTS = ('bgr0', 'bgra')
+
+
+# Read fps, frame count and frame size from the container headers without
+# decoding any frames. Falls back to OpenCV's properties without PyAV.
+# frame_count is estimated from the duration when the container has no count.
+def probe_video(video_path):
+    if av is None:
+        vidObj = cv2.VideoCapture(video_path)
+        try:
+            return {
+                'fps': vidObj.get(cv2.CAP_PROP_FPS),
+                'frame_count': int(vidObj.get(cv2.CAP_PROP_FRAME_COUNT)),
+                'width': int(vidObj.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                'height': int(vidObj.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                'codec': None,
+            }
+        finally:
+            vidObj.release()
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate or stream.guessed_rate or 0)
+        frame_count = stream.frames
+        if not frame_count and container.duration and fps:
+            frame_count = int(round(container.duration / av.time_base * fps))
+        return {
+            'fps': fps,
+            'frame_count': frame_count,
+            'width': stream.codec_context.width,
+            'height': stream.codec_context.height,
+            'codec': stream.codec_context.name,
+        }
+
+
+def get_video_properties(video_path):
+    probe = probe_video(video_path)
+    return probe['fps'], probe['frame_count'], (probe['width'], probe['height'])
+
+
+def count_frames(video_path):
+    vidObj = cv2.VideoCapture(video_path)
+    frame_count = int(vidObj.get(cv2.CAP_PROP_FRAME_COUNT))
+    if frame_count <= 0:
+        # Container has no usable frame count, walk the packets without decoding
+        frame_count = 0
+        while vidObj.grab():
+            frame_count += 1
+    vidObj.release()
+    return frame_count
+
+
+# Yield decoded frames, decoding ahead on a background thread into a bounded
+# queue so that at most `window` frames are held in memory at any time.
+# If the consumer stops early the reader thread stops too.
+def read_frames(video_path, window=8):
+    frames = queue.Queue(maxsize=window)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        vidObj = cv2.VideoCapture(video_path)
+        try:
+            success, image = vidObj.read()
+            while success and put(image):
+                success, image = vidObj.read()
+        finally:
+            vidObj.release()
+            put(_END_OF_STREAM)
+
+    threading.Thread(target=reader, daemon=True).start()
+
+    try:
+        while True:
+            image = frames.get()
+            if image is _END_OF_STREAM:
+                return
+            yield image
+    finally:
+        stop.set()
+        while True:
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                break
+
+
+# Pass frames through, reporting progress(fraction) after each one is consumed.
+# Nothing is reported when the total is unknown.
+def track_progress(frames, total, progress):
+    for count, frame in enumerate(frames, 1):
+        yield frame
+        if total > 0:
+            progress(count / total)
+
+
+# Random access to a handful of frames with a single open of the container.
+# Frames are visited in sorted order: short gaps are walked with grab(),
+# longer ones use a seek. Returns {frame_number: frame} for the frames found.
+def read_frames_at(video_path, frame_numbers, max_walk=32):
+    frames = {}
+    vidObj = cv2.VideoCapture(video_path)
+    try:
+        total_frames = int(vidObj.get(cv2.CAP_PROP_FRAME_COUNT))
+        position = 0
+        for frame_number in sorted(set(frame_numbers)):
+            if total_frames > 0 and frame_number >= total_frames:
+                print(f"Frame number {frame_number} exceeds total frames ({total_frames})")
+                continue
+            if frame_number - position > max_walk or frame_number < position:
+                vidObj.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                position = frame_number
+            while position < frame_number and vidObj.grab():
+                position += 1
+            success, image = vidObj.read()
+            if not success:
+                break
+            frames[frame_number] = image
+            position = frame_number + 1
+    finally:
+        vidObj.release()
+    return frames
+
+
+# A payload is either raw bytes, embedded as-is from the first slot, or a
+# callable that embeds itself into the frame (e.g. payload.embed_payload
+# bound to its data and depth)
+def apply_payload(frame, data):
+    if callable(data):
+        return data(frame)
+    return embed_data(frame, data, in_place=True)
+
+
+# Embed payloads into the targeted frames as they stream past.
+# `payloads` is a list of (frame_number, data) applied in order, so a later
+# payload aimed at the same frame overwrites an earlier one as it always has.
+# `replacements` maps frame numbers to frames that were embedded ahead of
+# time (e.g. shards) and are swapped in before any payloads are applied.
+def embed_frames(frames, payloads, replacements=None):
+    replacements = replacements or {}
+    targets = {frame_number: [] for frame_number in replacements}
+    for frame_number, data in payloads:
+        targets.setdefault(frame_number, []).append(data)
+
+    embedded = set()
+    for index, frame in enumerate(frames):
+        if index in replacements:
+            frame = replacements[index]
+            embedded.add(index)
+        for data in targets.get(index, ()):
+            frame = apply_payload(frame, data)
+            embedded.add(index)
+        yield frame
+
+    missing = set(targets) - embedded
+    if missing:
+        raise ValueError(f"Video ended before target frames {sorted(missing)} were reached")
+
+
+def write_video(frames, output_video_path, fps, resolution):
+    if av is not None:
+        return write_video_intra(frames, output_video_path, fps, resolution)
+
+    out = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'FFV1'), fps, resolution)
+    count = 0
+    try:
+        for frame in frames:
+            out.write(frame)
+            count += 1
+    finally:
+        out.release()
+    print(f"Video saved as {output_video_path} ({count} frames)")
+    return count
+
+
+# FFV1 with every frame a keyframe (gop_size=1). OpenCV's writer lets the
+# range coder state carry across frames, which ties each frame to the one
+# before it; intra-only output can later be spliced packet by packet.
+def write_video_intra(frames, output_video_path, fps, resolution):
+    width, height = resolution
+    container = av.open(output_video_path, 'w')
+    try:
+        stream = container.add_stream('ffv1', rate=Fraction(fps or 25).limit_denominator(100000))
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = 'bgr0'
+        stream.codec_context.gop_size = 1
+
+        count = 0
+        for frame in frames:
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format='bgr24')):
+                container.mux(packet)
+            count += 1
+        for packet in stream.encode():
+            container.mux(packet)
+    finally:
+        container.close()
+    print(f"Video saved as {output_video_path} ({count} frames)")
+    return count
+
+
+# Splice mode: copy untouched packets straight into the output container and
+# decode/embed/re-encode only the targeted frames. Only possible when the
+# source is intra-only FFV1, so a replacement packet cannot disturb its
+# neighbours. Returns the frame count, or None if the source cannot be
+# spliced and the caller should fall back to a full re-encode.
+def splice_video(video_path, output_video_path, payloads, replacements=None, progress=None):
+    if av is None:
+        return None
+
+    replacements = replacements or {}
+    targets = {frame_number: [] for frame_number in replacements}
+    for frame_number, data in payloads:
+        targets.setdefault(frame_number, []).append(data)
+
+    source = av.open(video_path)
+    try:
+        in_stream = source.streams.video[0]
+        decoder = in_stream.codec_context
+        if decoder.name != 'ffv1' or decoder.pix_fmt not in SPLICE_PIX_FMTS:
+            return None
+
+        encoder = av.CodecContext.create('ffv1', 'w')
+        encoder.width = decoder.width
+        encoder.height = decoder.height
+        encoder.pix_fmt = decoder.pix_fmt
+        encoder.time_base = in_stream.time_base
+        encoder.gop_size = 1
+        encoder.open()
+        if encoder.extradata != decoder.extradata:
+            # Replacement packets would not match the stream's global header
+            return None
+
+        output = av.open(output_video_path, 'w')
+        completed = False
+        try:
+            out_stream = output.add_stream_from_template(in_stream)
+            total = in_stream.frames
+            count = 0
+            for packet in source.demux(in_stream):
+                if packet.dts is None:
+                    continue
+                if not packet.is_keyframe:
+                    return None
+
+                if count in targets:
+                    if count in replacements:
+                        frame = replacements[count]
+                    else:
+                        frame = decoder.decode(packet)[0].to_ndarray(format='bgr24')
+                    for data in targets[count]:
+                        frame = apply_payload(frame, data)
+                    replacement = av.VideoFrame.from_ndarray(frame, format='bgr24').reformat(format=encoder.pix_fmt)
+                    replacement.pts = packet.pts
+                    replacement.time_base = in_stream.time_base
+                    encoded = encoder.encode(replacement)
+                    for new_packet in encoded:
+                        new_packet.pts = packet.pts
+                        new_packet.dts = packet.dts
+                        new_packet.time_base = packet.time_base
+                        new_packet.stream = out_stream
+                        output.mux(new_packet)
+                else:
+                    packet.stream = out_stream
+                    output.mux(packet)
+                count += 1
+                if progress is not None and total:
+                    progress(count / total)
+
+            missing = set(targets) - set(range(count))
+            if missing:
+                raise ValueError(f"Video ended before target frames {sorted(missing)} were reached")
+            completed = True
+        finally:
+            output.close()
+    finally:
+        source.close()
+
+    print(f"Video spliced into {output_video_path} ({count} frames, {len(targets)} re-encoded)")
+    return count if completed else None
+
+
+# Produce the embedded video, splicing when the source allows it and falling
+# back to a full streaming re-encode otherwise. Returns the frame count.
+# A re-encode reads its frames from `store` (a frame_store.FrameStore of the
+# same video) when given instead of decoding them.
+# `progress`, if given, is called with the fraction of frames written.
+def embed_video(video_path, output_video_path, payloads, splice=True, replacements=None, progress=None, store=None):
+    if splice:
+        frame_count = splice_video(video_path, output_video_path, payloads, replacements, progress)
+        if frame_count is not None:
+            return frame_count
+
+    if store is not None:
+        fps, total, resolution = store.fps, len(store), store.resolution
+        source = store.frames(copies={frame_number for frame_number, _ in payloads})
+    else:
+        fps, total, resolution = get_video_properties(video_path)
+        source = read_frames(video_path)
+    frames = embed_frames(source, payloads, replacements)
+    if progress is not None:
+        frames = track_progress(frames, total, progress)
+    return write_video(frames, output_video_path, fps, resolution)
+
+
+def is_intra_ffv1(video_path):
+    if av is None:
+        return False
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        if stream.codec_context.name != 'ffv1' or stream.codec_context.pix_fmt not in SPLICE_PIX_FMTS:
+            return False
+        # Demux only, no decoding
+        return all(packet.is_keyframe for packet in container.demux(stream) if packet.dts is not None)
+
+
+# Decode an upload once into intra-only FFV1 so any later embed into it can
+# be spliced. Returns (carrier_path, frame_count); the carrier is the upload
+# itself when it is already spliceable or PyAV is not available.
+# `progress`, if given, is called with the fraction of frames decoded.
+def prepare_carrier(video_path, carrier_path, progress=None):
+    if av is None or is_intra_ffv1(video_path):
+        return video_path, count_frames(video_path)
+    fps, total, resolution = get_video_properties(video_path)
+    frames = read_frames(video_path)
+    if progress is not None:
+        frames = track_progress(frames, total, progress)
+    frame_count = write_video_intra(frames, carrier_path, fps, resolution)
+    return carrier_path, frame_count
+
+
+# Decode from a readable file object, e.g. an upload that is still arriving,
+# into an intra-only FFV1 carrier. The source is read strictly front to back.
+# Returns (frame_count, fps, resolution).
+def decode_to_carrier(source, carrier_path, progress=None):
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate or stream.guessed_rate or 0)
+        resolution = (stream.codec_context.width, stream.codec_context.height)
+        frames = (frame.to_ndarray(format='bgr24') for frame in container.decode(stream))
+        if progress is not None:
+            frames = track_progress(frames, stream.frames, progress)
+        frame_count = write_video_intra(frames, carrier_path, fps, resolution)
+    return frame_count, fps, resolution
+
+
+# Decode the frames in `targets` from a readable file object front to back,
+# e.g. a video that is still arriving, keeping only those frames.
+# `on_frame(frame_number, frame, frame_count)` is called for each and may
+# return further frame numbers to collect. FFV1 keyframes that are not
+# wanted are demuxed but not decoded; the last one is kept back in case the
+# next packet is an inter frame that refers to it. Returns {frame_number: frame}.
+def collect_frames(source, targets, on_frame=None):
+    targets = set(targets)
+    frames = {}
+
+    def collect(frame_number, frame, frame_count):
+        frames[frame_number] = frame.to_ndarray(format='bgr24')
+        if on_frame is not None:
+            targets.update(on_frame(frame_number, frames[frame_number], frame_count) or ())
+
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        decoder = stream.codec_context
+        frame_count = stream.frames
+        if decoder.name != 'ffv1':
+            # Codecs that may reorder frames are decoded in full
+            for frame_number, frame in enumerate(container.decode(stream)):
+                if frame_number in targets:
+                    collect(frame_number, frame, frame_count)
+            return frames
+
+        held = None
+        frame_number = 0
+        for packet in container.demux(stream):
+            if packet.dts is None:
+                continue
+            if packet.is_keyframe and frame_number not in targets:
+                held = packet
+            else:
+                if held is not None and not packet.is_keyframe:
+                    decoder.decode(held)
+                held = None
+                decoded = decoder.decode(packet)
+                if frame_number in targets and decoded:
+                    collect(frame_number, decoded[0], frame_count)
+            frame_number += 1
+    return frames
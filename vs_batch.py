@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Crypto.PublicKey import RSA
+
+import VSserver
+import VSClient
+
+# Headless batch embedding/extraction over a manifest, without Flask or the
+# socket handshake. Uses the same prepare/embed/extract functions as the web
+# apps. The manifest is JSON lines, one job per line:
+#
+#   {"mode": "embed", "video": "in.mp4", "message": "...", "output": "out.avi"}
+#   {"mode": "extract", "video": "out.avi", "secret1": 7, "secret2": 12, "public_key": "out.avi.pub.pem"}
+#
+# Embed jobs may give "secret1"/"secret2"; otherwise they are drawn from the
+# same range the Diffie-Hellman exchange produces. The embed reduces them
+# modulo the video's frame count, and the report records the reduced values,
+# which are the frame numbers to extract from. Extract jobs reduce the same
+# way, so raw secrets work too. Each embed job writes the signing public key
+# next to its output. One JSON line per job is written to the report, and
+# one error line per manifest line that is not a JSON object.
+
+
+def draw_secrets():
+    _, _, prime, _ = VSserver.diffie_hellman_exchange()
+    secret1 = random.randint(1, prime - 1)
+    secret2 = random.randint(1, prime - 1)
+    # Ensure Key Frame and Message Frame are not the same, as the server does
+    if secret1 == secret2:
+        secret2 += 1
+    return secret1, secret2
+
+
+def run_embed(job):
+    if 'secret1' in job and 'secret2' in job:
+        secret1, secret2 = int(job['secret1']), int(job['secret2'])
+    else:
+        secret1, secret2 = draw_secrets()
+
+    session = VSserver.Session(job['video'], job['message'])
+    prepared = VSserver.prepare_session(session)
+    try:
+        frame_count = VSserver.embed_prepared(prepared, secret1, secret2, job['output'])
+    finally:
+        VSserver.release_prepared(prepared)
+
+    public_key_path = job.get('public_key', job['output'] + '.pub.pem')
+    with open(public_key_path, 'wb') as f:
+        f.write(prepared['public_key'])
+
+    return {
+        'output': job['output'],
+        'secret1': secret1 % prepared['frame_count'],
+        'secret2': secret2 % prepared['frame_count'],
+        'public_key': public_key_path,
+        'frame_count': frame_count,
+        'payload_bytes': len(prepared['encrypted_message']),
+    }
+
+
+def run_extract(job):
+    with open(job['public_key'], 'rb') as f:
+        public_key = RSA.import_key(f.read())
+    secret1, secret2 = int(job['secret1']), int(job['secret2'])
+    frame_count = VSClient.count_frames(job['video'])
+    if frame_count > 0:
+        secret1, secret2 = secret1 % frame_count, secret2 % frame_count
+    message, is_valid_signature = VSClient.extract_message(job['video'], secret1, secret2, public_key)
+    return {'message': message, 'signature_valid': is_valid_signature}
+
+
+def run_job(job):
+    start = time.perf_counter()
+    try:
+        if job.get('mode') == 'embed':
+            result = run_embed(job)
+        elif job.get('mode') == 'extract':
+            result = run_extract(job)
+        else:
+            raise ValueError(f"Unknown mode {job.get('mode')!r}")
+        status = {'status': 'ok', **result}
+    except Exception as e:
+        status = {'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    return {**job, **status, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+# Returns (jobs, error records for the lines that are not a JSON object)
+def read_manifest(path):
+    jobs = []
+    invalid = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                invalid.append({'line': line_number, 'status': 'error', 'error': f"Invalid JSON: {e}"})
+                continue
+            if not isinstance(job, dict):
+                invalid.append({'line': line_number, 'status': 'error',
+                                'error': f"Expected a JSON object, got {type(job).__name__}"})
+                continue
+            jobs.append(job)
+    return jobs, invalid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embed or extract hidden messages over a manifest of videos")
+    parser.add_argument('manifest', help="JSON-lines file with one job per line")
+    parser.add_argument('--report', default='report.jsonl', help="JSON-lines report to write")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="jobs run at once")
+    parser.add_argument('--depth', type=int, default=VSserver.embed_depth, help="bits per channel (1-4)")
+    parser.add_argument('--no-splice', action='store_true', help="always re-encode the whole video")
+    args = parser.parse_args(argv)
+
+    VSserver.embed_depth = args.depth
+    VSserver.splice_mode = not args.no_splice
+    os.makedirs('uploads', exist_ok=True)
+    VSserver.key_pool.start()
+
+    jobs, invalid = read_manifest(args.manifest)
+    failures = len(invalid)
+    total = len(jobs) + len(invalid)
+    with open(args.report, 'w') as report, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for record in invalid:
+            report.write(json.dumps(record) + '\n')
+            print(f"line {record['line']}: {record['status']} ({record['error']})")
+        report.flush()
+        for future in as_completed([pool.submit(run_job, job) for job in jobs]):
+            record = future.result()
+            failures += record['status'] != 'ok'
+            report.write(json.dumps(record) + '\n')
+            report.flush()
+            print(f"{record.get('mode')} {record.get('video')}: {record['status']} ({record['seconds']}s)")
+
+    print(f"{total - failures}/{total} jobs succeeded, report written to {args.report}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())